@@ -0,0 +1,9 @@
+"""
+Find, restore and delete documents whose keys carry a collection id prefix.
+
+Run with python -m cid_prefix_keys COMMAND; see --help for the commands.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
@@ -0,0 +1,497 @@
+"""
+Command line of the cid key prefix repair tool.
+
+Subcommands:
+  scan          report the copies of every cid-prefixed doc
+  audit         scan and print the XATTRs of every copy
+  restore       add the docs without their cid prefix (--delete removes the originals)
+  delete        delete the cid-prefixed docs
+  verify        check that the docs were restored with their bodies and flags
+  estimate      estimate the number of cid-prefixed docs from random keys
+  add-test-doc  add a cid-prefixed test doc
+  serve         run the jobs sent over a Unix socket on warm connections
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import json
+import math
+import os
+import select
+import sys
+import time
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter
+
+from . import doc_id_index
+from . import durable_writes
+from . import engine
+from . import profiling
+from . import progress
+from . import result_writer
+
+COMMANDS = ('scan', 'audit', 'restore', 'delete', 'verify', 'estimate', 'add-test-doc', 'serve')
+
+
+def check_port(s):
+    v = int(s)
+    if v <= 0 or v >= 0x10000:
+        raise ArgumentTypeError(f'{v} is not a valid port number')
+    return v
+
+def check_shard(s):
+    try:
+        index, count = (int(v) for v in s.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f'{s} is not of the form i/n')
+    if count <= 0 or index < 0 or index >= count:
+        raise ArgumentTypeError(f'{s} is not a valid shard')
+    return index, count
+
+def check_confidence(s):
+    v = float(s)
+    if v <= 0 or v >= 1:
+        raise ArgumentTypeError(f'{v} is not a confidence level between 0 and 1')
+    return v
+
+def check_processes(s):
+    v = int(s)
+    if v <= 0:
+        raise ArgumentTypeError(f'{v} is not a valid number of processes')
+    return v
+
+def check_positive(s):
+    v = int(s)
+    if v <= 0:
+        raise ArgumentTypeError(f'{v} is not a positive integer')
+    return v
+
+def connection_parser():
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('-b', '--bucket', default='default')
+    parser.add_argument('-u', '--username', default='Administrator')
+    parser.add_argument('-p', '--password', default='password')
+    parser.add_argument('--port', default=11210, type=check_port, help='KV node port (11210 or 11207 for TLS)')
+    parser.add_argument('--host', default='localhost', help='KV node hostname')
+    parser.add_argument('--tls', default=False, action='store_true')
+    parser.add_argument('--tls-verify', dest='tls_verify', action='store_true',
+                        help='Verify the TLS certificates and host names of the nodes')
+    parser.add_argument('--tls-ca', dest='tls_ca', metavar='FILE',
+                        help='CA certificates to verify the nodes against (implies --tls-verify)')
+    parser.add_argument('--tls-cert', dest='tls_cert', metavar='FILE', help='TLS client certificate')
+    parser.add_argument('--tls-key', dest='tls_key', metavar='FILE', help='Private key of --tls-cert')
+    parser.add_argument('--cid', type=int, help='Collection id of the key prefix (default 0)')
+    parser.add_argument('--zero-copy', dest='zero_copy', action='store_true',
+                        help='Pass document bodies through as views of the received buffers')
+    return parser
+
+def run_parser():
+    parser = ArgumentParser(add_help=False)
+    ids = parser.add_mutually_exclusive_group()
+    ids.add_argument('--index', metavar='FILE',
+                     help='Load the doc ids from an index saved by --save-index instead of querying')
+    ids.add_argument('--ids-from', dest='ids_from', metavar='FILE',
+                     help="Read the doc ids from FILE ('-' for stdin), one JSON string per line, "
+                          'instead of querying')
+    parser.add_argument('--all-cids', dest='all_cids', action='store_true',
+                        help='Handle the docs of every cid in one pass, restoring each '
+                             'into the collection of its key prefix')
+    parser.add_argument('--query-ranges', dest='query_ranges', default=1, type=check_positive,
+                        metavar='N', help='Query the ids as N disjoint ranges of ids, concurrently')
+    parser.add_argument('--save-index', metavar='FILE', dest='save_index',
+                        help='Save the doc ids and their vbuckets to an index file')
+    parser.add_argument('--search-all-vbs', dest='search_all_vbs', action='store_true', help='Search all vbuckets')
+    parser.add_argument('--replica-reads', dest='replica_reads', action='store_true',
+                        help='Probe docs on replicas, reading the active only for the body '
+                             'to restore and the CAS of a delete')
+    parser.add_argument('--print-xattrs', dest='print_xattrs', action='store_true')
+    parser.add_argument('--shard', metavar='I/N', type=check_shard,
+                        help='Only handle the ids whose vbucket modulo N is I')
+    parser.add_argument('--processes', default=1, type=check_processes,
+                        help='Split the work across this many local processes')
+    parser.add_argument('-v', '--verbose', default=result_writer.SUMMARY, action='count',
+                        help='Report the outcome of each id (-v) and every copy found (-vv)')
+    parser.add_argument('--output', default='-', metavar='FILE',
+                        help='Write per-id results to FILE instead of stdout')
+    parser.add_argument('--format', default='text', choices=result_writer.FORMATS,
+                        help='Format of per-id results')
+    parser.add_argument('--background-writer', dest='background_writer', action='store_true',
+                        help='Format and write per-id results on a background thread')
+    parser.add_argument('--progress', action='store_true',
+                        help='Periodically report progress, rates and ETA on stderr')
+    parser.add_argument('--progress-interval', dest='progress_interval', default=10.0, type=float,
+                        metavar='SECONDS', help='Interval of progress reports and metrics snapshots')
+    parser.add_argument('--metrics-file', dest='metrics_file', metavar='FILE',
+                        help='Periodically write a metrics snapshot to FILE')
+    parser.add_argument('--metrics-format', dest='metrics_format', default='json',
+                        choices=progress.METRICS_FORMATS)
+    parser.add_argument('--profile', choices=profiling.PROFILERS,
+                        help='Time each stage, and profile the run with cProfile, '
+                             'a sampling profiler or tracemalloc')
+    parser.add_argument('--profile-file', dest='profile_file', default='cid-prefix-keys-profile.txt',
+                        metavar='FILE', help='Write the profile to FILE')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='Record the KV traffic to FILE, for python mc_capture.py '
+                             'to summarize or replay')
+    parser.add_argument('--capture-values', dest='capture_values', action='store_true',
+                        help='Also record the document values')
+    return parser
+
+def write_parser():
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('--throttle', action='store_true',
+                        help='Slow down or pause writes to nodes under memory, disk queue or ops pressure')
+    parser.add_argument('--throttle-interval', dest='throttle_interval', default=1.0,
+                        type=float, metavar='SECONDS', help='Interval between stats polls')
+    parser.add_argument('--max-mem-ratio', dest='max_mem_ratio', default=0.95, type=float,
+                        help='Pause writes once mem_used reaches this fraction of the high watermark')
+    parser.add_argument('--max-disk-queue', dest='max_disk_queue', default=1000000, type=int,
+                        metavar='ITEMS', help='Pause writes once the disk write queue reaches this size')
+    parser.add_argument('--max-ops', dest='max_ops', type=int, metavar='OPS',
+                        help='Pause writes once a node serves this many ops/s')
+    return parser
+
+def build_parser(parser_class=ArgumentParser):
+    parser = parser_class(prog='python -m cid_prefix_keys', allow_abbrev=False,
+                          description='Find, restore and delete docs whose '
+                          'keys carry a collection id prefix')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='COMMAND')
+    connection, run, write = connection_parser(), run_parser(), write_parser()
+    read_only = dict(restore=False, delete=False, durability=None, confirm_persisted=False,
+                     throttle=False)
+
+    commands.add_parser('scan', parents=[connection, run], allow_abbrev=False,
+                        help='Report the copies of every cid-prefixed doc') \
+        .set_defaults(**read_only)
+    # --print-xattrs is forced on in parse_args(): set_defaults() would
+    # change the default of the action shared with the other subcommands
+    commands.add_parser('audit', parents=[connection, run], allow_abbrev=False,
+                        help='Scan and print the XATTRs of every copy') \
+        .set_defaults(**read_only)
+
+    restore = commands.add_parser('restore', parents=[connection, run, write], allow_abbrev=False,
+                                  help='Add the docs without their cid key prefix')
+    restore.add_argument('--delete', action='store_true', help='Delete the cid-prefixed originals')
+    restore.add_argument('--durability', choices=durable_writes.LEVELS,
+                         help='Restore with durable writes of this level, many in flight per node')
+    restore.add_argument('--durability-timeout', dest='durability_timeout', type=int, metavar='MS',
+                         help='Server-side timeout of durable writes')
+    restore.add_argument('--durable-window', dest='durable_window', default=64,
+                         type=check_positive, metavar='N', help='Durable writes in flight per node')
+    restore.add_argument('--confirm-persisted', dest='confirm_persisted', action='store_true',
+                         help='Only delete the originals once their restored doc is persisted')
+    restore.add_argument('--confirm-timeout', dest='confirm_timeout', default=30.0, type=float,
+                         metavar='SECONDS', help='Keep the originals of docs not persisted by then')
+    restore.add_argument('--observe-batch', dest='observe_batch', default=256,
+                         type=check_positive, metavar='N', help='Keys confirmed per OBSERVE')
+    restore.set_defaults(restore=True)
+
+    commands.add_parser('delete', parents=[connection, run, write], allow_abbrev=False,
+                        help='Delete the cid-prefixed docs') \
+        .set_defaults(restore=False, delete=True, durability=None, confirm_persisted=False)
+
+    verify = commands.add_parser('verify', parents=[connection, run], allow_abbrev=False,
+                                 help='Check that the docs were restored with their bodies and flags')
+    verify.add_argument('--window', default=64, type=check_positive, metavar='N',
+                        help='Lookups in flight per node')
+    verify.set_defaults(**read_only)
+
+    estimate = commands.add_parser('estimate', parents=[connection], allow_abbrev=False,
+                                   help='Estimate the number of cid-prefixed docs, counting '
+                                        'every copy, from random keys')
+    estimate.add_argument('--all-cids', dest='all_cids', action='store_true',
+                          help='Estimate the docs with the prefix of any cid')
+    estimate.add_argument('--samples', default=1000, type=check_positive, metavar='N',
+                          help='Random keys to sample per node')
+    estimate.add_argument('--confidence', default=0.95, type=check_confidence,
+                          help='Confidence level of the interval')
+
+    add_test_doc = commands.add_parser('add-test-doc', parents=[connection], allow_abbrev=False,
+                                       help='Add a test doc with cid key prefix')
+    add_test_doc.add_argument('doc_id', metavar='DOC_ID')
+
+    serve = commands.add_parser('serve', parents=[connection], allow_abbrev=False,
+                                help='Run the jobs sent over a Unix socket on warm connections')
+    serve.add_argument('--socket', required=True, metavar='PATH', help='Path of the Unix socket')
+    serve.add_argument('--revalidate', default=30.0, type=float, metavar='SECONDS',
+                       help='Check the connections and vbucket map of those idle for this long')
+    return parser
+
+def parse_args(argv=None, parser=None):
+    options = (parser or build_parser()).parse_args(argv)
+    if options.command == 'audit':
+        options.print_xattrs = True
+    return options
+
+def legacy_argv(args):
+    """Translate the flags of manage-cid-prefix-keys.py to a subcommand."""
+    if args and (args[0] in COMMANDS or args[0] in ('-h', '--help')):
+        return args
+    args = list(args)
+    for i, arg in enumerate(args):
+        if arg == '--add-test-doc' and i + 1 < len(args):
+            return ['add-test-doc', args[i + 1]] + args[:i] + args[i + 2:]
+        if arg.startswith('--add-test-doc='):
+            return ['add-test-doc', arg.partition('=')[2]] + args[:i] + args[i + 1:]
+    if '--estimate' in args:
+        args.remove('--estimate')
+        return ['estimate'] + args
+    if '--verify' in args:
+        args.remove('--verify')
+        return ['verify'] + args
+    if '--restore' in args:
+        args.remove('--restore')
+        return ['restore'] + args
+    if '--delete' in args:
+        args.remove('--delete')
+        return ['delete'] + args
+    if '--print-xattrs' in args:
+        args.remove('--print-xattrs')
+        return ['audit'] + args
+    return ['scan'] + args
+
+def describe_cid(cid):
+    return 'every cid' if cid in (None, doc_id_index.ALL_CIDS) else f'cid {cid}'
+
+def load_doc_ids(options):
+    if options.index is not None:
+        doc_ids = doc_id_index.DocIdIndex(options.index)
+        cid = doc_id_index.ALL_CIDS if options.cid is None else options.cid
+        if doc_ids.cid != cid:
+            raise SystemExit(f'{options.index} holds the ids of {describe_cid(doc_ids.cid)}, '
+                             f'not {describe_cid(cid)}')
+        print(f'Loaded {len(doc_ids)} cid-prefixed doc ids from {options.index}\n')
+        return doc_ids
+    from . import ids
+    if options.ids_from is not None:
+        doc_ids = ids.read_doc_ids(options.ids_from)
+        print(f'Read {len(doc_ids)} cid-prefixed doc ids from {options.ids_from}\n')
+        return doc_ids
+    doc_ids = ids.query_doc_ids(options)
+    print(f'Indexed {len(doc_ids)} cid-prefixed doc ids\n')
+    return doc_ids
+
+def open_writer(options, worker=False):
+    if options.output == '-':
+        # Writes of at most PIPE_BUF bytes keep the lines of workers
+        # sharing a pipe from interleaving
+        return result_writer.ResultWriter(
+            sys.stdout, options.format, options.verbose, options.background_writer,
+            buffer_size=select.PIPE_BUF if worker else 65536, header=not worker)
+    stream = open(options.output, 'a' if worker else 'w')
+    return result_writer.ResultWriter(stream, options.format, options.verbose,
+                                      options.background_writer, header=not worker)
+
+def close_writer(writer):
+    writer.close()
+    if writer.stream is not sys.stdout:
+        writer.stream.close()
+
+def shard_path(path, shard):
+    """Return the path of the file of a worker, e.g. for one per shard."""
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{shard[0]}{ext}'
+
+def start_reporter(options, total, shard=None):
+    if not options.progress and options.metrics_file is None:
+        return progress.ProgressReporter()
+    metrics_file = options.metrics_file
+    labels = {'bucket': options.bucket, 'cid': 'all' if options.cid is None else options.cid}
+    if shard is not None:
+        labels['shard'] = f'{shard[0]}/{shard[1]}'
+    if metrics_file is not None and options.processes > 1:
+        # One file per worker, e.g. for the node exporter textfile collector
+        metrics_file = shard_path(metrics_file, shard)
+    reporter = progress.ProgressReporter(
+        total, options.progress_interval, sys.stderr if options.progress else None,
+        metrics_file, options.metrics_format, labels, engine.node_name)
+    reporter.start()
+    return reporter
+
+def new_repairer(options, reporter, **kwargs):
+    return engine.CidPrefixRepairer.from_options(options, reporter=reporter, log=sys.stdout,
+                                                 throttle_log=sys.stderr, **kwargs)
+
+def repair(repairer, doc_ids, writer, options, shard=None):
+    with repairer:
+        return write_results(repairer, doc_ids, writer, options, shard)
+
+def write_results(repairer, doc_ids, writer, options, shard=None):
+    if options.command == 'verify':
+        results = repairer.verify(doc_ids, shard, options.window)
+    else:
+        results = repairer.results(doc_ids, shard)
+    for r in results:
+        writer.write(r.level, r.event, r.id, **r.fields)
+    return repairer.counts
+
+# Ids inherited by forked worker processes
+shard_doc_ids = []
+
+def start_profiler(options, shard=None):
+    if getattr(options, 'profile', None) is None:
+        return None
+    path = options.profile_file
+    if shard is not None:
+        # One profile per worker
+        path = shard_path(path, shard)
+    profiler = profiling.Profiler(options.profile, path)
+    profiler.start()
+    return profiler
+
+def open_capture(options, shard=None):
+    if getattr(options, 'capture', None) is None:
+        return None
+    import mc_capture
+    path = options.capture if shard is None else shard_path(options.capture, shard)
+    return mc_capture.WireCapture(path, options.capture_values)
+
+def close_capture(capture):
+    if capture is not None:
+        capture.close()
+
+def repair_shard(options, shard):
+    # Runs in a forked worker process; keep the per-op lines of the
+    # workers from interleaving mid-line.
+    sys.stdout.reconfigure(line_buffering=True, write_through=False)
+    profiler = start_profiler(options, shard)
+    writer = open_writer(options, worker=True)
+    reporter = start_reporter(options, len(shard_doc_ids), shard)
+    capture = open_capture(options, shard)
+    try:
+        repairer = new_repairer(options, reporter, timer=profiler and profiler.timer,
+                                capture=capture)
+        return repair(repairer, shard_doc_ids, writer, options, shard)
+    finally:
+        reporter.stop()
+        close_writer(writer)
+        close_capture(capture)
+        if profiler is not None:
+            profiler.stop()
+
+def repair_in_processes(doc_ids, options):
+    global shard_doc_ids
+    import multiprocessing
+    # Split this invocation's shard into one sub-shard per process.
+    # vbid % (n * processes) == i + j * n implies vbid % n == i
+    index, count = options.shard or (0, 1)
+    shards = [(index + j * count, count * options.processes) for j in range(options.processes)]
+    sys.stdout.flush()
+    # The workers inherit the ids when forked rather than have them pickled
+    shard_doc_ids = doc_ids
+    with multiprocessing.get_context('fork').Pool(options.processes) as pool:
+        results = pool.starmap(repair_shard, [(options, shard) for shard in shards])
+    return sum(results, Counter())
+
+def run(doc_ids, options, timer=None):
+    """Repair doc_ids as options ask for and return the counts of outcomes."""
+    writer = open_writer(options)
+    if options.processes > 1:
+        # Workers append to the output after the parent's CSV header
+        writer.flush()
+        counts = repair_in_processes(doc_ids, options)
+    else:
+        reporter = start_reporter(options, len(doc_ids), options.shard)
+        capture = open_capture(options)
+        with new_repairer(options, reporter, timer=timer, capture=capture) as repairer:
+            print()
+            counts = write_results(repairer, doc_ids, writer, options, options.shard)
+        reporter.stop()
+        close_capture(capture)
+    close_writer(writer)
+    return counts
+
+def add_test_doc(options):
+    with new_repairer(options, None) as repairer:
+        print()
+        for r in repairer.add_test_doc(options.doc_id):
+            escaped_key = json.dumps(r.id.decode(errors='ignore'))
+            if r.event == 'added':
+                print('Added test doc', escaped_key, 'vb:', r.fields['vb'])
+            else:
+                print('Already exists', escaped_key)
+
+def print_estimate(options):
+    from . import estimate
+    with new_repairer(options, None, restore=False, delete=False) as repairer:
+        started = time.monotonic()
+        try:
+            result = estimate.estimate(repairer, options.samples, options.confidence)
+        except estimate.EstimateError as e:
+            raise SystemExit(str(e))
+        elapsed = time.monotonic() - started
+    print(f'\nSampled {result.samples} keys of {result.items} items on {len(result.nodes)} nodes '
+          f'in {elapsed:.1f}s, {result.hits} cid-prefixed')
+    print('\n------------------------------------------')
+    print('Estimated cid-prefixed docs', round(result.value))
+    print(f'{result.confidence:.0%} confidence interval {math.floor(result.low)} to {math.ceil(result.high)}')
+
+def save_index(options, doc_ids):
+    with new_repairer(options, None, restore=False, delete=False) as repairer:
+        repairer.save_index(options.save_index, doc_ids)
+
+def print_summary(options, counts):
+    print('\n------------------------------------------')
+    if options.command == 'verify':
+        print('Verified', counts['verified'])
+        print('Missing', counts['missing'])
+        print('Mismatched', counts['mismatched'])
+        print('Not found', counts['not_found'])
+        if options.all_cids:
+            print('Failed', counts['failed'])
+        return
+    print('Not found', counts['not_found'])
+    print('Already exist', counts['already_exist'])
+    print('Added', counts['added'])
+    print('Deleted', counts['deleted'])
+    if options.replica_reads:
+        print('Changed', counts['changed'])
+    if options.confirm_persisted:
+        print('Unconfirmed', counts['unconfirmed'])
+    if options.durability is not None:
+        print('Ambiguous', counts['ambiguous'])
+    if options.durability is not None or options.all_cids:
+        print('Failed', counts['failed'])
+
+def resolve_cid(options):
+    """Default --cid to 0 unless --all-cids; raises ValueError if invalid."""
+    if getattr(options, 'all_cids', False):
+        if options.cid is not None:
+            raise ValueError('--cid and --all-cids are mutually exclusive')
+    elif options.cid is None:
+        options.cid = 0
+    elif options.cid < 0 or options.cid >= engine.NUM_CIDS:
+        raise ValueError(f'{options.cid} is not a valid cid')
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.command == 'serve':
+        from . import daemon
+        daemon.serve(options)
+        return
+    try:
+        resolve_cid(options)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if options.command == 'add-test-doc':
+        add_test_doc(options)
+        return
+    if options.command == 'estimate':
+        print_estimate(options)
+        return
+    if options.print_xattrs:
+        options.verbose = max(options.verbose, result_writer.RESULTS)
+    profiler = start_profiler(options)
+    timer = profiler.timer if profiler is not None else profiling.NULL_TIMER
+    with timer.stage('query'):
+        doc_ids = load_doc_ids(options)
+    if options.save_index is not None:
+        save_index(options, doc_ids)
+        print(f'Saved doc id index to {options.save_index}\n')
+    counts = run(doc_ids, options, timer)
+    print_summary(options, counts)
+    if profiler is not None:
+        profiler.stop()
+        print('Profile written to', options.profile_file)
@@ -0,0 +1,274 @@
+"""
+Daemon running repair jobs on warm connections, sent over a Unix socket.
+
+A job is a JSON object on a line of its own, e.g.
+
+  {"command": "restore", "bucket": "travel", "cid": 8, "delete": true,
+   "ids": ["\\u0008airline_10", "\\u0008airline_137"]}
+
+command is one of JOB_COMMANDS and ids the cid-prefixed doc ids.  The other
+fields are the options of the subcommand, named as their attribute, e.g.
+"all_cids": true or "durability": "majority".  bucket and cid default to
+those of the daemon, and verbose to 1, the outcome of each id.
+
+The results are streamed back as NDJSON records, followed by one with the
+event "done" and the counts, or with the event "error".  Several jobs may
+be sent over one connection; they run one after the other.  Connections
+run side by side, each job with a repairer of its own.
+
+Repairers stay connected to the cluster between jobs.  One idle for longer
+than --revalidate is checked before its next job, and reconnected if a
+node went away or the vbucket map changed.  One whose job failed is
+dropped.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+
+from . import cli
+from . import result_writer
+
+JOB_COMMANDS = ('scan', 'audit', 'restore', 'delete', 'verify')
+
+# The fields a job may set besides command and ids
+JOB_OPTIONS = ('bucket', 'cid', 'all_cids', 'delete', 'search_all_vbs', 'replica_reads',
+               'print_xattrs', 'shard', 'verbose', 'window', 'durability',
+               'durability_timeout', 'durable_window', 'confirm_persisted', 'confirm_timeout',
+               'observe_batch', 'throttle', 'throttle_interval', 'max_mem_ratio',
+               'max_disk_queue', 'max_ops')
+
+# Always those of the daemon
+CONNECTION_OPTIONS = ('host', 'port', 'username', 'password', 'tls', 'tls_verify', 'tls_ca',
+                      'tls_cert', 'tls_key', 'zero_copy')
+
+# The options a pooled repairer is reset to for each job; it is only
+# reused for jobs which agree on all the others
+PER_JOB_OPTIONS = ('command', 'cid', 'all_cids', 'verbose', 'print_xattrs', 'search_all_vbs',
+                   'shard', 'window')
+
+
+class JobParser(ArgumentParser):
+    """Parses the command line of a job, raising ValueError on errors."""
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def job_argv(job):
+    """Translate a job to the command line of its subcommand."""
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a JSON object')
+    command = job.get('command')
+    if command not in JOB_COMMANDS:
+        raise ValueError(f'command must be one of {", ".join(JOB_COMMANDS)}')
+    argv = [command]
+    for name, value in job.items():
+        if name in ('command', 'ids'):
+            continue
+        if name not in JOB_OPTIONS:
+            raise ValueError(f'unknown job field {name!r}')
+        flag = '--' + name.replace('_', '-')
+        if name == 'verbose':
+            if not isinstance(value, int) or value < 0:
+                raise ValueError('verbose must be a level of 0 or more')
+            argv += ['-v'] * value
+        elif value is True:
+            argv.append(flag)
+        elif value is not False and value is not None:
+            argv += [flag, str(value)]
+    return argv
+
+
+def job_options(job, server_options, parser):
+    """Return the options of job, as those of its command line."""
+    options = cli.parse_args(job_argv(job), parser)
+    for name in CONNECTION_OPTIONS:
+        setattr(options, name, getattr(server_options, name))
+    if 'bucket' not in job:
+        options.bucket = server_options.bucket
+    if 'cid' not in job and not options.all_cids:
+        options.cid = server_options.cid
+    cli.resolve_cid(options)
+    if 'verbose' not in job:
+        options.verbose = result_writer.RESULTS
+    if options.print_xattrs:
+        options.verbose = max(options.verbose, result_writer.RESULTS)
+    return options
+
+
+def job_ids(job):
+    ids = job.get('ids')
+    if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids):
+        raise ValueError('ids must be a list of strings')
+    return ids
+
+
+def pool_key(options):
+    return tuple(sorted((name, value) for name, value in vars(options).items()
+                        if name not in PER_JOB_OPTIONS))
+
+
+class RepairerPool(object):
+    """Connected repairers kept between jobs, by the options they were
+    connected with."""
+
+    def __init__(self, revalidate=30.0):
+        self.revalidate = revalidate
+        # pool_key => [(repairer, idle since)], the most recently used last
+        self.idle = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def checkout(self, options):
+        """Return (key, repairer) of a connected repairer for options."""
+        key = pool_key(options)
+        while True:
+            with self.lock:
+                if not self.idle[key]:
+                    break
+                repairer, since = self.idle[key].pop()
+            if time.monotonic() - since < self.revalidate or repairer.is_current():
+                return key, repairer
+            repairer.close()
+        repairer = cli.new_repairer(options, None)
+        try:
+            repairer.connect()
+        except BaseException:
+            repairer.close()
+            raise
+        return key, repairer
+
+    def checkin(self, key, repairer):
+        with self.lock:
+            self.idle[key].append((repairer, time.monotonic()))
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for repairer, _ in idle:
+                    repairer.close()
+            self.idle.clear()
+
+
+def write_record(out, record):
+    out.write(json.dumps(record) + '\n')
+    out.flush()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """Runs the jobs sent over one connection, one after the other."""
+
+    def handle(self):
+        try:
+            with self.request.makefile('w', encoding='utf-8', newline='\n') as out:
+                for line in self.rfile:
+                    if line.strip():
+                        self.server.run_job(line, out)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            pass
+
+
+class JobServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, options):
+        super().__init__(path, JobHandler)
+        self.options = options
+        self.parser = cli.build_parser(JobParser)
+        self.pool = RepairerPool(options.revalidate)
+
+    def run_job(self, line, out):
+        started = time.monotonic()
+        try:
+            job = json.loads(line)
+            options = job_options(job, self.options, self.parser)
+            doc_ids = job_ids(job)
+        except ValueError as e:
+            write_record(out, {'event': 'error', 'error': str(e)})
+            return
+        try:
+            key, repairer = self.pool.checkout(options)
+        except Exception as e:
+            write_record(out, {'event': 'error', 'error': f'connect: {e}'})
+            return
+        repairer.reset(options.cid, options.verbose, options.print_xattrs, options.search_all_vbs)
+        writer = result_writer.ResultWriter(out, 'ndjson', options.verbose)
+        try:
+            counts = cli.write_results(repairer, doc_ids, writer, options, options.shard)
+        except Exception as e:
+            # Its connections may be midway through a request
+            repairer.close()
+            writer.close()
+            write_record(out, {'event': 'error', 'error': str(e) or type(e).__name__,
+                               'counts': dict(repairer.counts)})
+            return
+        self.pool.checkin(key, repairer)
+        writer.close()
+        write_record(out, {'event': 'done', 'counts': dict(counts),
+                           'seconds': round(time.monotonic() - started, 6)})
+
+
+def remove_stale_socket(path):
+    """Remove the socket left at path by a daemon which died."""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise SystemExit(f'{path} exists and is not a socket')
+    with socket.socket(socket.AF_UNIX) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+    raise SystemExit(f'A daemon is already serving {path}')
+
+
+def serve(options):
+    """Serve jobs on options.socket until interrupted or terminated."""
+    path = options.socket
+    remove_stale_socket(path)
+    # Jobs run with the credentials of the daemon, so only its user may
+    # connect
+    umask = os.umask(0o177)
+    try:
+        server = JobServer(path, options)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Serving jobs on', path, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+        os.unlink(path)
+
+
+def submit(path, job):
+    """Send job to the daemon serving path and yield the records sent back,
+    up to and including the done or error record."""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(job).encode() + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as f:
+            for line in f:
+                yield json.loads(line)
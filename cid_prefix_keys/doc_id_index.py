@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Compact on-disk index of cid-prefixed doc ids.
+
+The index holds the UTF-8 encoded ids back to back in a single arena with an
+offset array, together with the vbucket of each prefixed id and of the id with
+its cid prefix stripped.  It is memory-mapped when loaded, so that tens of
+millions of ids cost no more than the page cache they occupy.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import array
+import mmap
+import struct
+import sys
+
+# magic, byte order, cid, num_vbuckets, count, arena size
+HEADER_FMT = '<8sBxxxIIQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+MAGIC = b'CIDIDX01'
+# cid of an index holding the ids of every cid
+ALL_CIDS = 0xffffffff
+BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+class DocIdIndex(object):
+    """Read-only view of an index file written by write_index()."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byte_order, self.cid, self.num_vbuckets, self.count, arena_size = \
+            struct.unpack_from(HEADER_FMT, self.mm)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a doc id index')
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise ValueError(f'{path} was written on a machine of different byte order')
+        self.view = view = memoryview(self.mm)
+        pos = HEADER_SIZE
+        self.offsets = view[pos:pos + 8 * (self.count + 1)].cast('Q')
+        pos += 8 * (self.count + 1)
+        self.raw_vbids = view[pos:pos + 2 * self.count].cast('H')
+        pos += 2 * self.count
+        self.stripped_vbids = view[pos:pos + 2 * self.count].cast('H')
+        pos += 2 * self.count
+        self.arena = view[pos:pos + arena_size]
+
+    def close(self):
+        for view in (self.offsets, self.raw_vbids, self.stripped_vbids, self.arena, self.view):
+            view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return str(self.arena[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def entries(self):
+        """Yield (doc_id, raw_vbid, stripped_vbid) for every id."""
+        offsets, arena = self.offsets, self.arena
+        raw_vbids, stripped_vbids = self.raw_vbids, self.stripped_vbids
+        for i in range(self.count):
+            yield (str(arena[offsets[i]:offsets[i + 1]], 'utf-8'),
+                   raw_vbids[i], stripped_vbids[i])
+
+
+def write_index(path, doc_ids, cid, num_vbuckets, get_vbid, strip_prefix):
+    """Write doc_ids to an index file at path.
+
+    get_vbid maps an id to its vbucket; strip_prefix removes the cid key
+    prefix of an id, to compute its second vbucket."""
+    offsets = array.array('Q', [0])
+    raw_vbids = array.array('H')
+    stripped_vbids = array.array('H')
+    arena = bytearray()
+    for doc_id in doc_ids:
+        arena += doc_id.encode()
+        offsets.append(len(arena))
+        raw_vbids.append(get_vbid(doc_id))
+        stripped_vbids.append(get_vbid(strip_prefix(doc_id)))
+    with open(path, 'wb') as f:
+        f.write(struct.pack(HEADER_FMT, MAGIC, BYTE_ORDERS[sys.byteorder],
+                            cid, num_vbuckets, len(raw_vbids), len(arena)))
+        offsets.tofile(f)
+        raw_vbids.tofile(f)
+        stripped_vbids.tofile(f)
+        f.write(arena)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Windowed durable writes.
+
+A synchronous durable write waits for replication (and possibly
+persistence) before the next one can be sent.  DurableAddWindow instead keeps
+a bounded number of durable ADDs in flight on a connection and retries the
+ones which come back ambiguous, in progress or temporarily failed, so that a
+durable restore runs at close to pipelined speed.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import heapq
+import time
+
+import memcacheConstants
+
+# Statuses after which the write is sent again
+RETRY_STATUSES = {memcacheConstants.ERR_ETMPFAIL,
+                  memcacheConstants.ERR_EBUSY,
+                  memcacheConstants.ERR_SYNC_WRITE_IN_PROGRESS,
+                  memcacheConstants.ERR_SYNC_WRITE_AMBIGUOUS,
+                  memcacheConstants.ERR_SYNC_WRITE_RE_COMMIT_IN_PROGRESS}
+
+LEVELS = {
+    'majority': memcacheConstants.DURABILITY_LEVEL_MAJORITY,
+    'majority-and-persist-active': memcacheConstants.DURABILITY_LEVEL_MAJORITY_AND_PERSIST_TO_ACTIVE,
+    'persist': memcacheConstants.DURABILITY_LEVEL_PERSIST_TO_MAJORITY,
+}
+
+
+class DurableAdd(object):
+    """A durable ADD and the state of its attempts."""
+
+    __slots__ = ('key', 'vbid', 'flags', 'value', 'dtype', 'context',
+                 'attempts', 'ambiguous')
+
+    def __init__(self, key, vbid, flags, value, dtype, context):
+        self.key = key
+        self.vbid = vbid
+        self.flags = flags
+        self.value = value
+        self.dtype = dtype
+        self.context = context
+        self.attempts = 0
+        # Set once an attempt came back ambiguous: a later EEXISTS may then
+        # have been caused by that very attempt.
+        self.ambiguous = False
+
+
+class DurableAddWindow(object):
+    """Keeps up to window durable ADDs in flight on one MemcachedClient.
+
+    The client must not be used for anything else while writes are in
+    flight. on_complete(write, status) is called, from submit() or drain(),
+    once a write succeeds, fails with a non-retryable status or runs out of
+    retries."""
+
+    def __init__(self, client, on_complete, window=64,
+                 level=memcacheConstants.DURABILITY_LEVEL_MAJORITY,
+                 timeout=None, max_retries=10, retry_delay=0.01,
+                 max_retry_delay=1.0, on_send=None, on_retry=None):
+        assert window > 0
+        self.client = client
+        self.on_complete = on_complete
+        self.window = window
+        self.level = level
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_send = on_send
+        self.on_retry = on_retry
+        self.inflight = {}
+        self.retries = []  # heap of (due, sequence, write)
+        self.sequence = 0
+        self.opaque = 0
+
+    def submit(self, key, vbid, flags, value, dtype=memcacheConstants.DTYPE_JSON,
+               context=None):
+        """Queue a durable ADD, waiting for responses while the window is full."""
+        self._send_due_retries()
+        while len(self.inflight) >= self.window:
+            self._receive()
+            self._send_due_retries()
+        write = DurableAdd(key, vbid, flags, value, dtype, context)
+        self._send(write)
+        return write
+
+    def drain(self):
+        """Wait until every write, including its retries, has completed."""
+        while self.inflight or self.retries:
+            self._send_due_retries()
+            if self.inflight:
+                self._receive()
+            elif self.retries:
+                time.sleep(max(0.0, self.retries[0][0] - time.monotonic()))
+
+    def _send(self, write):
+        self.opaque = (self.opaque + 1) & 0xffffffff
+        write.attempts += 1
+        self.client.vbucketId = write.vbid
+        self.client.send_add_durable(write.key, 0, write.flags, write.value,
+                                     self.opaque, self.level, self.timeout,
+                                     write.dtype)
+        self.inflight[self.opaque] = write
+        if self.on_send is not None:
+            self.on_send(write)
+
+    def _send_due_retries(self):
+        now = time.monotonic()
+        while (self.retries and self.retries[0][0] <= now
+               and len(self.inflight) < self.window):
+            _, _, write = heapq.heappop(self.retries)
+            self._send(write)
+
+    def _receive(self):
+        opaque, status, cas, data = self.client.recv_status()
+        write = self.inflight.pop(opaque)
+        if status in RETRY_STATUSES and write.attempts <= self.max_retries:
+            if status == memcacheConstants.ERR_SYNC_WRITE_AMBIGUOUS:
+                write.ambiguous = True
+            delay = min(self.max_retry_delay,
+                        self.retry_delay * 2 ** (write.attempts - 1))
+            self.sequence += 1
+            heapq.heappush(self.retries, (time.monotonic() + delay, self.sequence, write))
+            if self.on_retry is not None:
+                self.on_retry(write, status)
+            return
+        self.on_complete(write, status)
@@ -0,0 +1,684 @@
+"""
+Probing, restoring and deleting cid-prefixed documents over KV.
+
+CidPrefixRepairer owns its connections and configuration, so that several
+of them can repair different buckets or clusters side by side in one
+process, each on a thread of its own.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import hashlib
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from zlib import crc32
+
+import leb128
+import mc_bin_client
+import memcacheConstants
+
+from . import doc_id_index
+from . import durable_writes
+from . import persistence
+from . import profiling
+from . import progress
+from . import result_writer
+from . import throttle
+
+# The cids whose key prefix is a single control character, which the N1QL
+# query and the repair are limited to
+NUM_CIDS = 32
+
+# The outcomes counted by a repairer
+COUNTS = ('not_found', 'already_exist', 'added', 'deleted', 'ambiguous', 'failed', 'changed',
+          'unconfirmed')
+
+
+def node_name(client):
+    return f'{client.host}:{client.port}'
+
+
+class Result(object):
+    """An event about a doc id, e.g. that it was added or deleted.
+
+    level is the result_writer verbosity level the event belongs to."""
+
+    __slots__ = ('level', 'event', 'id', 'fields')
+
+    def __init__(self, level, event, id, fields):
+        self.level = level
+        self.event = event
+        self.id = id
+        self.fields = fields
+
+    def __repr__(self):
+        return f'Result({self.event!r}, {self.id!r}, {self.fields!r})'
+
+
+class CidPrefixRepairer(object):
+    """Probes, restores and deletes the cid-prefixed docs of one bucket.
+
+    results() yields a Result for everything that happens to each id, while
+    counts keeps the totals.  Without restore or delete the docs are only
+    probed.  With cid=None the docs of every cid are repaired in one pass,
+    each into the collection of its own key prefix.  A repairer is not
+    thread-safe; run one per thread."""
+
+    def __init__(self, host='localhost', port=11210, bucket='default',
+                 username='Administrator', password='password', cid=0,
+                 tls=False, ssl_context=None, zero_copy=False,
+                 restore=False, delete=False, print_xattrs=False,
+                 search_all_vbs=False, replica_reads=False,
+                 durability=None, durability_timeout=None, durable_window=64,
+                 confirm_persisted=False, confirm_timeout=30.0, observe_batch=256,
+                 throttle=False, throttle_interval=1.0, max_mem_ratio=0.95,
+                 max_disk_queue=1000000, max_ops=None,
+                 verbosity=result_writer.DETAILS, reporter=None, log=None,
+                 throttle_log=None, timer=None, capture=None):
+        self.host = host
+        self.port = port
+        self.bucket = bucket
+        self.username = username
+        self.password = password
+        # None for the docs of every cid
+        self.cid = cid
+        self.tls = tls
+        self.ssl_context = ssl_context
+        self.zero_copy = zero_copy
+        self.restore = restore
+        self.delete = delete
+        self.print_xattrs = print_xattrs
+        self.search_all_vbs = search_all_vbs
+        self.replica_reads = replica_reads
+        # One of durable_writes.LEVELS, or None for plain adds
+        self.durability = durability
+        self.durability_timeout = durability_timeout
+        self.durable_window = durable_window
+        self.confirm_persisted = confirm_persisted
+        self.confirm_timeout = confirm_timeout
+        self.observe_batch = observe_batch
+        self.throttle = throttle
+        self.throttle_interval = throttle_interval
+        self.max_mem_ratio = max_mem_ratio
+        self.max_disk_queue = max_disk_queue
+        self.max_ops = max_ops
+        # Results above this level are not even created
+        self.verbosity = verbosity
+        self.reporter = reporter or progress.ProgressReporter()
+        # Times the stages when profiling
+        self.timer = timer or profiling.NULL_TIMER
+        # An mc_capture.WireCapture recording the traffic of every connection
+        self.capture = capture
+        self.log = log
+        self.throttle_log = throttle_log
+        self.prefix = None if cid is None else leb128.prefix(cid).decode(errors='ignore')
+        self.counts = Counter(dict.fromkeys(COUNTS, 0))
+        self.kv_nodes = []
+        self.vb_map = {}
+        # Revision of the cluster config vb_map was built from
+        self.cluster_rev = None
+        # vbid => clients of the nodes holding its replicas, when reading from replicas
+        self.replica_map = {}
+        self.replica_turn = count()
+        # Node client => DurableAddWindow on a dedicated connection to that node
+        self.durable_windows = {}
+        self.throttle_monitor = None
+        self.persistence_gate = None
+        self.events = deque()
+
+    @classmethod
+    def from_options(cls, options, **kwargs):
+        """Create a repairer from the options of the command line."""
+        tls_verify = options.tls_verify or options.tls_ca is not None
+        ssl_context = None
+        if options.tls:
+            ssl_context = mc_bin_client.create_ssl_context(
+                tls_verify, options.tls_ca, certfile=options.tls_cert, keyfile=options.tls_key)
+        durability = getattr(options, 'durability', None)
+        for name in ('restore', 'delete', 'print_xattrs', 'search_all_vbs', 'replica_reads',
+                     'confirm_persisted', 'confirm_timeout', 'observe_batch', 'throttle',
+                     'throttle_interval', 'max_mem_ratio', 'max_disk_queue', 'max_ops',
+                     'durability_timeout', 'durable_window'):
+            if hasattr(options, name):
+                kwargs.setdefault(name, getattr(options, name))
+        if hasattr(options, 'verbose'):
+            kwargs.setdefault('verbosity', options.verbose)
+        return cls(options.host, options.port, options.bucket, options.username,
+                   options.password, options.cid, options.tls, ssl_context,
+                   options.zero_copy,
+                   durability=durable_writes.LEVELS[durability] if durability else None,
+                   **kwargs)
+
+    def __enter__(self):
+        if not self.kv_nodes:
+            self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Connections
+
+    def connect_client(self, host, port):
+        if self.log is not None:
+            print('connect_client', host, port, file=self.log)
+        client = mc_bin_client.MemcachedClient(host, port, use_ssl=self.tls, zero_copy=self.zero_copy,
+                                               ssl_context=self.ssl_context, capture=self.capture)
+        client.req_features = {memcacheConstants.FEATURE_SELECT_BUCKET,
+                               memcacheConstants.FEATURE_JSON,
+                               memcacheConstants.FEATURE_XATTR,
+                               memcacheConstants.FEATURE_COLLECTIONS}
+        client.hello('manage-cid-prefix-keys')
+        client.sasl_auth_plain(self.username, self.password)
+        client.bucket_select(self.bucket)
+        return client
+
+    def connect(self):
+        """Connect to every node of the cluster."""
+        with self.timer.stage('connect'):
+            self._connect()
+
+    def _connect(self):
+        client = self.connect_client(self.host, self.port)
+        cluster_config = client.get_cluster_config()
+        client.close()
+        self.cluster_rev = cluster_config.get('rev')
+        for server in cluster_config['vBucketServerMap']['serverList']:
+            host = server.split(':')
+            port = int(host[1])
+            host = host[0]
+            if host == '$HOST':
+                host = self.host
+            if self.tls:
+                port = self.port
+            self.kv_nodes.append(self.connect_client(host, port))
+        for vbid, servers in enumerate(cluster_config['vBucketServerMap']['vBucketMap']):
+            self.vb_map[vbid] = self.kv_nodes[servers[0]]
+            if self.replica_reads:
+                self.replica_map[vbid] = [self.kv_nodes[i] for i in servers[1:] if i >= 0]
+        assert len(self.vb_map) in [1024, 128, 64]
+        if self.durability is not None and self.restore:
+            for client in self.kv_nodes:
+                self.durable_windows[client] = self.open_durable_window(client.host, client.port)
+        if self.confirm_persisted and self.restore and self.delete:
+            self.persistence_gate = persistence.PersistenceGate(
+                self.vb_map.__getitem__, self.persisted_delete, self.unpersisted_delete,
+                self.observe_batch, self.confirm_timeout,
+                on_observe=lambda client: self.reporter.op('observe', client))
+        if self.throttle and (self.restore or self.delete):
+            self.throttle_monitor = throttle.ThrottleMonitor(
+                self.kv_nodes, lambda client: self.connect_client(client.host, client.port),
+                self.throttle_interval, self.max_mem_ratio, self.max_disk_queue,
+                self.max_ops, stream=self.throttle_log, node_name=node_name)
+            self.throttle_monitor.start()
+
+    def close(self):
+        if self.throttle_monitor is not None:
+            self.throttle_monitor.stop()
+            self.throttle_monitor = None
+        for client in self.kv_nodes:
+            client.close()
+        for window in self.durable_windows.values():
+            window.client.close()
+        self.kv_nodes.clear()
+        self.vb_map.clear()
+        self.replica_map.clear()
+        self.durable_windows.clear()
+        self.persistence_gate = None
+
+    def is_current(self):
+        """Return whether the connections are still open and the vbucket
+        map is that of the latest cluster config."""
+        try:
+            for client in self.kv_nodes:
+                client.noop()
+            for window in self.durable_windows.values():
+                window.client.noop()
+            cluster_config = self.kv_nodes[0].get_cluster_config()
+        except (mc_bin_client.MemcachedError, OSError, EOFError):
+            return False
+        return cluster_config.get('rev') == self.cluster_rev
+
+    def reset(self, cid=0, verbosity=result_writer.DETAILS, print_xattrs=False,
+              search_all_vbs=False):
+        """Start another run on the same connections, with fresh counts and
+        the settings which the connections do not depend on."""
+        self.cid = cid
+        self.prefix = None if cid is None else leb128.prefix(cid).decode(errors='ignore')
+        self.verbosity = verbosity
+        self.print_xattrs = print_xattrs
+        self.search_all_vbs = search_all_vbs
+        self.counts = Counter(dict.fromkeys(COUNTS, 0))
+        self.events.clear()
+
+    def open_durable_window(self, host, port):
+        # Durable adds are pipelined, so they need a connection of their own
+        client = self.connect_client(host, port)
+        return durable_writes.DurableAddWindow(
+            client, self.durable_add_done, self.durable_window, self.durability,
+            self.durability_timeout,
+            on_send=lambda write: self.reporter.op('add', client),
+            on_retry=lambda write, status: self.reporter.error('add', client))
+
+    def read_client(self, vbid):
+        """Return (client, is_replica) to send a read-only request for vbid to.
+
+        With replica_reads the replicas of vbid take turns; vbuckets without
+        a replica are read from the active."""
+        replicas = self.replica_map.get(vbid)
+        if not replicas:
+            return self.vb_map[vbid], False
+        return replicas[next(self.replica_turn) % len(replicas)], True
+
+    def get_vbid(self, doc_id):
+        if isinstance(doc_id, str):
+            doc_id = doc_id.encode()
+        return ((crc32(doc_id) >> 16) & 0x7fff) % len(self.vb_map)
+
+    def split_id(self, id):
+        """Return the cid of id and id without its cid prefix."""
+        if self.prefix is not None:
+            return self.cid, id.removeprefix(self.prefix)
+        try:
+            cid, stripped = leb128.decode_key(id.encode())
+        except ValueError:
+            return None, id
+        if cid >= NUM_CIDS:
+            return None, id
+        return cid, stripped.decode()
+
+    def strip_prefix(self, id):
+        return self.split_id(id)[1]
+
+    def get_doc_entries(self, doc_ids):
+        """Yield (id, raw_vbid, stripped_vbid) for each id, using the vbids
+        precomputed by a DocIdIndex if it matches the cluster."""
+        if isinstance(doc_ids, doc_id_index.DocIdIndex) and doc_ids.num_vbuckets == len(self.vb_map):
+            yield from doc_ids.entries()
+            return
+        get_vbid, strip_prefix = self.get_vbid, self.strip_prefix
+        for id in doc_ids:
+            yield id, get_vbid(id), get_vbid(strip_prefix(id))
+
+    def save_index(self, path, doc_ids):
+        cid = doc_id_index.ALL_CIDS if self.cid is None else self.cid
+        doc_id_index.write_index(path, doc_ids, cid, len(self.vb_map), self.get_vbid,
+                                 self.strip_prefix)
+
+    # KV operations
+
+    def get_doc_meta(self, id, vbids):
+        copies = []
+        vbs = range(len(self.vb_map)) if self.search_all_vbs else dict.fromkeys(vbids)
+        key = leb128.encode_key(id)
+        for vbid in vbs:
+            client, replica = self.read_client(vbid)
+            client.vbucketId = vbid
+            with self.timer.stage('probe'):
+                if replica:
+                    # Replicas do not serve GET_META, and GET_REPLICA skips tombstones
+                    status, flags, cas, _ = client.getr_status(key)
+                    deleted = False
+                else:
+                    status, deleted, flags, _, _, cas = client.get_meta_status(key)
+            self.reporter.op('probe', client)
+            if status == memcacheConstants.ERR_SUCCESS:
+                if not deleted:
+                    copies.append((cas, flags, vbid))
+            elif status != memcacheConstants.ERR_KEY_ENOENT:
+                self.reporter.error('probe', client)
+                raise mc_bin_client.MemcachedError(status, None)
+        return copies
+
+    def get_doc(self, id, vbid):
+        # Always from the active: a lagging replica would restore a stale body
+        client: mc_bin_client.MemcachedClient = self.vb_map[vbid]
+        client.vbucketId = vbid
+        with self.timer.stage('fetch'):
+            status, flags, cas, doc = client.get_status(leb128.encode_key(id))
+        self.reporter.op('fetch', client)
+        if status == memcacheConstants.ERR_KEY_ENOENT:
+            return None
+        if status != memcacheConstants.ERR_SUCCESS:
+            self.reporter.error('fetch', client)
+            raise mc_bin_client.MemcachedError(status, bytes(doc).decode(errors='backslashreplace'))
+        return doc, cas, flags
+
+    def add_doc(self, id, cid, value, flags, vbid=None):
+        if vbid is None:
+            vbid = self.get_vbid(id)
+        client: mc_bin_client.MemcachedClient = self.vb_map[vbid]
+        client.vbucketId = vbid
+        self.throttle_wait(client)
+        self.reporter.op('add', client)
+        try:
+            with self.timer.stage('add'):
+                client.add_with_dtype(leb128.encode_key(id, cid), 0, flags, value, 1)
+        except mc_bin_client.ErrorKeyEexists:
+            raise
+        except mc_bin_client.MemcachedError:
+            self.reporter.error('add', client)
+            raise
+
+    def delete_doc(self, id, cas, vbid=None):
+        if vbid is None:
+            vbid = self.get_vbid(id)
+        client: mc_bin_client.MemcachedClient = self.vb_map[vbid]
+        client.vbucketId = vbid
+        self.throttle_wait(client)
+        self.reporter.op('delete', client)
+        try:
+            with self.timer.stage('delete'):
+                client.delete(leb128.encode_key(id), cas)
+        except mc_bin_client.MemcachedError:
+            self.reporter.error('delete', client)
+            raise
+
+    def get_active_cas(self, id, vbid):
+        """Return the CAS of the live copy of id in active vbid, or None."""
+        client: mc_bin_client.MemcachedClient = self.vb_map[vbid]
+        client.vbucketId = vbid
+        with self.timer.stage('cas'):
+            status, deleted, _, _, _, cas = client.get_meta_status(leb128.encode_key(id))
+        self.reporter.op('cas', client)
+        if status == memcacheConstants.ERR_KEY_ENOENT or deleted:
+            return None
+        if status != memcacheConstants.ERR_SUCCESS:
+            self.reporter.error('cas', client)
+            raise mc_bin_client.MemcachedError(status, None)
+        return cas
+
+    def get_xattrs(self, id, vbid):
+        client: mc_bin_client.MemcachedClient = self.vb_map[vbid]
+        client.vbucketId = vbid
+        key = leb128.encode_key(id)
+        with self.timer.stage('xattr'):
+            xkeys = client.subdoc_get(key, '$XTOC', 4)
+            self.reporter.op('xattr', client)
+            xattrs = {}
+            for xkey in xkeys:
+                xattrs[xkey] = client.subdoc_get(key, xkey, 4)
+                self.reporter.op('xattr', client)
+        return xattrs
+
+    def throttle_wait(self, client):
+        if self.throttle_monitor is not None:
+            with self.timer.stage('throttle'):
+                self.throttle_monitor.wait(client)
+
+    # Repair
+
+    def emit(self, level, event, id, **fields):
+        if level <= self.verbosity:
+            self.events.append(Result(level, event, id, fields))
+
+    def prepare(self, doc_ids, shard):
+        if not self.kv_nodes:
+            self.connect()
+        if shard is not None and self.reporter.total is not None:
+            # Shards are uneven; report progress against the ids of this one
+            self.reporter.total = self.count_shard(doc_ids, shard)
+
+    def count_shard(self, doc_ids, shard):
+        """Return how many of doc_ids have a vbucket in shard."""
+        index, count = shard
+        if isinstance(doc_ids, doc_id_index.DocIdIndex) and doc_ids.num_vbuckets == len(self.vb_map):
+            vbids = (raw_vbid for _, raw_vbid, _ in doc_ids.entries())
+        else:
+            vbids = map(self.get_vbid, doc_ids)
+        return sum(1 for vbid in vbids if vbid % count == index)
+
+    def results(self, doc_ids, shard=None):
+        """Repair doc_ids, yielding the Results as they come about.
+
+        With shard=(i, n) only the ids whose vbucket modulo n is i are
+        handled. Connects first unless already connected."""
+        self.prepare(doc_ids, shard)
+        events = self.events
+        for id, raw_vbid, stripped_vbid in self.get_doc_entries(doc_ids):
+            if shard is not None and raw_vbid % shard[1] != shard[0]:
+                continue
+            self.repair_one(id, raw_vbid, stripped_vbid)
+            while events:
+                yield events.popleft()
+        self.flush()
+        while events:
+            yield events.popleft()
+
+    def repair(self, doc_ids, shard=None):
+        """Repair doc_ids, discarding the Results, and return the counts."""
+        for _ in self.results(doc_ids, shard):
+            pass
+        return self.counts
+
+    def verify(self, doc_ids, shard=None, window=64, chunk_size=100000):
+        """Check the restored docs, yielding a Result for each id.
+
+        The restored doc must exist, and have the flags and body of the
+        newest cid-prefixed copy if any is left.  A chunk of ids at a time
+        is looked up with get_stream(), on every node in parallel."""
+        self.prepare(doc_ids, shard)
+        chunk = []
+        with ThreadPoolExecutor(len(self.kv_nodes)) as pool:
+            for entry in self.get_doc_entries(doc_ids):
+                if shard is not None and entry[1] % shard[1] != shard[0]:
+                    continue
+                chunk.append(entry)
+                if len(chunk) == chunk_size:
+                    yield from self.verify_chunk(pool, chunk, window)
+                    chunk = []
+            if chunk:
+                yield from self.verify_chunk(pool, chunk, window)
+
+    def verify_chunk(self, pool, chunk, window):
+        # Node client => vbid => keys to look up there
+        lookups = defaultdict(lambda: defaultdict(list))
+        checks = []
+        for id, raw_vbid, stripped_vbid in chunk:
+            cid, new_id = self.split_id(id)
+            if cid is None:
+                self.emit(result_writer.RESULTS, 'failed', id, reason='no collection id prefix')
+                self.counts['failed'] += 1
+                continue
+            key = leb128.encode_key(id)
+            sources = [(vbid, key) for vbid in dict.fromkeys((raw_vbid, stripped_vbid))]
+            target = (self.get_vbid(new_id), leb128.encode_key(new_id, cid))
+            for vbid, k in sources + [target]:
+                lookups[self.vb_map[vbid]][vbid].append(k)
+            checks.append((id, cid, new_id, sources, target))
+        found = {}
+        for (client, vbs), digests in zip(lookups.items(),
+                                          pool.map(self.get_digests, lookups.items(),
+                                                   [window] * len(lookups))):
+            found.update(digests)
+            # Counted here rather than on the pool threads, as op() takes no lock
+            self.reporter.op('verify', client, sum(map(len, vbs.values())))
+        for id, cid, new_id, sources, target in checks:
+            self.reporter.processed += 1
+            self.check_restored(id, cid, new_id, [found[s] for s in sources if s in found],
+                                found.get(target))
+            while self.events:
+                yield self.events.popleft()
+
+    def get_digests(self, lookup, window):
+        """Return (vbid, key) => (cas, flags, digest) of the docs found.
+
+        Runs on a thread of its own; each node is only read by one."""
+        client, vbs = lookup
+        digests = {}
+        for vbid, keys in vbs.items():
+            client.vbucketId = vbid
+            with self.timer.stage('verify'):
+                for key, (flags, cas, value) in client.get_stream(keys, window):
+                    digests[vbid, key] = (cas, flags, hashlib.blake2b(value, digest_size=16).digest())
+        return digests
+
+    def check_restored(self, id, cid, new_id, copies, restored):
+        counts = self.counts
+        if restored is None:
+            event = 'missing' if copies else 'not_found'
+            self.emit(result_writer.RESULTS, event, new_id, cid=cid)
+            counts[event] += 1
+            return
+        reason = None
+        if copies:
+            cas, flags, digest = max(copies)
+            if restored[1] != flags:
+                reason = 'flags'
+            elif restored[2] != digest:
+                reason = 'body'
+        if reason is not None:
+            self.emit(result_writer.RESULTS, 'mismatched', new_id, cid=cid, cas=cas, reason=reason)
+            counts['mismatched'] += 1
+        else:
+            self.emit(result_writer.DETAILS, 'verified', new_id, cid=cid)
+            counts['verified'] += 1
+
+    def flush(self):
+        """Wait for the durable writes and persistence confirmations in flight."""
+        if self.durable_windows:
+            with self.timer.stage('durable'):
+                for window in self.durable_windows.values():
+                    window.drain()
+        if self.persistence_gate is not None:
+            with self.timer.stage('observe'):
+                self.persistence_gate.flush()
+
+    def repair_one(self, id, raw_vbid, stripped_vbid):
+        counts = self.counts
+        self.reporter.processed += 1
+        copies = self.get_doc_meta(id, (raw_vbid, stripped_vbid))
+        if len(copies) == 0:
+            self.emit(result_writer.RESULTS, 'not_found', id)
+            counts['not_found'] += 1
+            return
+        copies.sort(reverse=True) # sort by cas
+        for (cas, flags, vbid) in copies:
+            self.emit(result_writer.DETAILS, 'got', id, cas=cas, flags=flags, vb=vbid)
+            if self.print_xattrs:
+                self.emit(result_writer.RESULTS, 'xattrs', id, vb=vbid, xattrs=self.get_xattrs(id, vbid))
+        cid, new_id = self.split_id(id)
+        if cid is None:
+            self.emit(result_writer.RESULTS, 'failed', id, reason='no collection id prefix')
+            counts['failed'] += 1
+            return
+        if self.restore and self.durable_windows:
+            self.restore_durably(id, cid, new_id, copies)
+            return
+        restored_one = False
+        restored_as = None
+        to_delete = []
+        for (cas, flags, vbid) in copies:
+            if self.restore and not restored_one:
+                # Only the body of the copy being restored is fetched
+                fetched = self.get_doc(id, vbid)
+                if fetched is None:
+                    self.emit(result_writer.RESULTS, 'not_found', id, vb=vbid)
+                    continue
+                doc, cas, flags = fetched
+                restored_as = new_id
+                try:
+                    self.add_doc(new_id, cid, doc, flags)
+                    self.emit(result_writer.RESULTS, 'added', new_id, cid=cid)
+                    counts['added'] += 1
+                    restored_one = True
+                except mc_bin_client.ErrorKeyEexists:
+                    self.emit(result_writer.RESULTS, 'already_exists', new_id, cid=cid)
+                    counts['already_exist'] += 1
+            if self.delete:
+                to_delete.append((cas, vbid))
+        if restored_as is not None:
+            self.delete_restored(id, cid, new_id, to_delete)
+        else:
+            for cas, vbid in to_delete:
+                self.delete_copy(id, cas, vbid)
+
+    def delete_copy(self, id, cas, vbid):
+        if self.replica_map and self.get_active_cas(id, vbid) != cas:
+            # The replica which was read lags behind the active: the copy has
+            # changed or gone since, so it is left alone
+            self.emit(result_writer.RESULTS, 'changed', id, vb=vbid)
+            self.counts['changed'] += 1
+            return
+        self.delete_doc(id, cas, vbid)
+        self.emit(result_writer.RESULTS, 'deleted', id, vb=vbid)
+        self.counts['deleted'] += 1
+
+    def delete_restored(self, id, cid, new_id, to_delete):
+        """Delete the copies of id which was restored as new_id.
+
+        With confirm_persisted this waits until new_id is persisted."""
+        if self.persistence_gate is not None and to_delete:
+            with self.timer.stage('observe'):
+                self.persistence_gate.submit(self.get_vbid(new_id), leb128.encode_key(new_id, cid),
+                                             (id, cid, new_id, to_delete))
+            return
+        for cas, vbid in to_delete:
+            self.delete_copy(id, cas, vbid)
+
+    def persisted_delete(self, context):
+        id, cid, new_id, to_delete = context
+        for cas, vbid in to_delete:
+            self.delete_copy(id, cas, vbid)
+
+    def unpersisted_delete(self, context, reason):
+        # Keep the originals of a document whose restored copy is not on disk
+        id, cid, new_id, to_delete = context
+        self.emit(result_writer.RESULTS, 'unconfirmed', new_id, cid=cid, reason=reason)
+        self.counts['unconfirmed'] += 1
+
+    def restore_durably(self, id, cid, new_id, copies):
+        """Submit a durable add of the newest copy which can be fetched.
+
+        The copies are only deleted once the add has completed, see
+        durable_add_done()."""
+        for i, (cas, flags, vbid) in enumerate(copies):
+            fetched = self.get_doc(id, vbid)
+            if fetched is None:
+                self.emit(result_writer.RESULTS, 'not_found', id, vb=vbid)
+                continue
+            doc, cas, flags = fetched
+            new_vbid = self.get_vbid(new_id)
+            self.throttle_wait(self.vb_map[new_vbid])
+            to_delete = [(cas, vbid)] + [(c[0], c[2]) for c in copies[i + 1:]] if self.delete else []
+            with self.timer.stage('durable'):
+                self.durable_windows[self.vb_map[new_vbid]].submit(
+                    leb128.encode_key(new_id, cid), new_vbid, flags, doc,
+                    context=(id, cid, new_id, to_delete))
+            return
+
+    def durable_add_done(self, write, status):
+        id, cid, new_id, to_delete = write.context
+        counts = self.counts
+        if status == memcacheConstants.ERR_SUCCESS:
+            self.emit(result_writer.RESULTS, 'added', new_id, cid=cid)
+            counts['added'] += 1
+        elif status == memcacheConstants.ERR_KEY_EEXISTS and write.ambiguous:
+            # Most likely stored by the earlier attempt which came back ambiguous
+            self.emit(result_writer.RESULTS, 'ambiguous', new_id, cid=cid)
+            counts['ambiguous'] += 1
+        elif status == memcacheConstants.ERR_KEY_EEXISTS:
+            self.emit(result_writer.RESULTS, 'already_exists', new_id, cid=cid)
+            counts['already_exist'] += 1
+        else:
+            # Keep the originals of a document which could not be restored
+            self.emit(result_writer.RESULTS, 'failed', new_id, cid=cid, status=status)
+            counts['failed'] += 1
+            return
+        self.delete_restored(id, cid, new_id, to_delete)
+
+    def add_test_doc(self, id):
+        """Add a cid-prefixed test doc to the vbuckets of its prefixed and
+        unprefixed ids and to another one, returning the Results."""
+        key = leb128.encode_key(id, self.cid)
+        results = []
+        try:
+            for vbid in (self.get_vbid(id), self.get_vbid(key), self.get_vbid(b'\0' + key)):
+                self.add_doc(key, 0, '{}', 0, vbid)
+                results.append(Result(result_writer.RESULTS, 'added', key, {'vb': vbid}))
+        except mc_bin_client.ErrorKeyEexists:
+            results.append(Result(result_writer.RESULTS, 'already_exists', key, {}))
+        return results
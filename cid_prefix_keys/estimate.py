@@ -0,0 +1,201 @@
+"""
+Estimate of the number of cid-prefixed docs from random keys.
+
+Each node is asked for random keys of the default collection with
+GET_RANDOM_KEY, in parallel.  The server picks a random vbucket and then a
+random key of it, so keys of sparse vbuckets come up more often than those
+of full ones.  Each sampled key is therefore weighted by the item count of
+its vbucket, and the weighted fraction of cid-prefixed keys is scaled by the
+item count of the node.  The copies of a cid-prefixed key may sit in the
+vbucket of its unprefixed id too, so the vbuckets holding it are probed to
+weight it right.  The confidence intervals of the nodes are added up into
+one for the bucket.
+
+Only the items of the default collection count, so a server which does not
+report them per collection and vbucket is refused: the items of the other
+collections, such as restored docs, would inflate the estimate.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import math
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+import leb128
+import mc_bin_client
+import memcacheConstants
+
+from . import engine
+
+
+def wilson_interval(hits, samples, z):
+    """Return the Wilson score interval of the proportion hits / samples."""
+    if samples == 0:
+        return 0.0, 1.0
+    p = hits / samples
+    denominator = 1 + z * z / samples
+    centre = (p + z * z / (2 * samples)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / samples + z * z / (4 * samples * samples)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+def ratio_interval(weights, hits, z):
+    """Return the weighted fraction of hits and its confidence interval.
+
+    The interval of the ratio estimator comes from the delta method; with
+    no hits or nothing but hits, where that collapses to a point, the
+    Wilson score interval of the unweighted samples bounds it instead."""
+    samples = len(weights)
+    total = sum(weights)
+    if samples == 0 or total == 0:
+        return 0.0, 0.0, 1.0
+    ratio = sum(w for w, hit in zip(weights, hits) if hit) / total
+    hit_count = sum(hits)
+    if hit_count == 0 or hit_count == samples:
+        low, high = wilson_interval(hit_count, samples, z)
+        return ratio, low, high
+    mean = total / samples
+    residuals = sum((w * hit - ratio * w) ** 2 for w, hit in zip(weights, hits))
+    se = math.sqrt(residuals / (samples - 1) / samples) / mean
+    return ratio, max(0.0, ratio - z * se), min(1.0, ratio + z * se)
+
+
+class EstimateError(Exception):
+    """The server does not report the item counts an estimate needs."""
+
+
+def vbucket_items(client):
+    """Return vbid => items of the default collection in the active
+    vbuckets of the node."""
+    try:
+        states = client.stats('vbucket-details')
+        stats = client.stats('collections-details')
+    except mc_bin_client.MemcachedError:
+        raise EstimateError(f'{engine.node_name(client)}: no items of the default collection '
+                            'per vbucket (stats collections-details)')
+    items = {}
+    for key, value in stats.items():
+        vb, _, name = key.partition(':')
+        if name == '0x0:items' and states.get(vb) == 'active':
+            items[int(vb[3:])] = int(value)
+    return items
+
+
+def default_collection_items(client):
+    """Return the items of the default collection in the active vbuckets
+    of the node."""
+    try:
+        stats = client.stats('collections-byid 0x0')
+    except mc_bin_client.MemcachedError:
+        stats = {}
+    for key, value in stats.items():
+        if key.endswith(':items'):
+            return int(value)
+    # curr_items would count the items of every collection
+    raise EstimateError(f'{engine.node_name(client)}: no items of the default collection '
+                        '(stats collections-byid)')
+
+
+class NodeSample(object):
+    """The random keys sampled from one node."""
+
+    __slots__ = ('client', 'items', 'weights', 'hits', 'ops')
+
+    def __init__(self, client, items):
+        self.client = client
+        self.items = items
+        # Per sampled key: the items of its vbucket, and whether it has the prefix
+        self.weights = []
+        self.hits = []
+        # Requests sent, tallied into the reporter once sampling is done
+        self.ops = 0
+
+
+class Estimate(object):
+    """Estimated number of cid-prefixed docs, with a confidence interval."""
+
+    def __init__(self, nodes, confidence):
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.nodes = nodes
+        self.confidence = confidence
+        self.items = sum(node.items for node in nodes)
+        self.samples = sum(len(node.hits) for node in nodes)
+        self.hits = sum(sum(node.hits) for node in nodes)
+        self.value = self.low = self.high = 0
+        for node in nodes:
+            ratio, low, high = ratio_interval(node.weights, node.hits, z)
+            self.value += node.items * ratio
+            self.low += node.items * low
+            self.high += node.items * high
+
+
+def is_prefixed(cid):
+    """Return a predicate of whether a default collection key, without its
+    own collection prefix, carries the prefix of cid (None for any cid)."""
+    if cid is None:
+        return lambda key: len(key) > 0 and key[0] < engine.NUM_CIDS
+    prefix = leb128.prefix(cid)
+    return lambda key: key.startswith(prefix)
+
+
+def prefixed_weight(repairer, node, key, vb_items):
+    """Return the weight of a sampled cid-prefixed key: the harmonic mean
+    of the item counts of the vbuckets of the node holding a copy of it."""
+    vbids = [vbid for vbid in dict.fromkeys((repairer.get_vbid(key), repairer.get_vbid(key[1:])))
+             if vbid in vb_items]
+    holding = []
+    client = node.client
+    for vbid in vbids:
+        client.vbucketId = vbid
+        status, deleted, _, _, _, _ = client.get_meta_status(leb128.encode_key(key))
+        node.ops += 1
+        if status == memcacheConstants.ERR_SUCCESS and not deleted:
+            holding.append(vbid)
+    if not holding:
+        # Gone since it was sampled
+        holding = vbids[:1]
+    if not holding or 0 in (vb_items[vbid] for vbid in holding):
+        return 0
+    return len(holding) / sum(1 / vb_items[vbid] for vbid in holding)
+
+
+def sample_node(repairer, client, samples, matches):
+    """Sample the keys of one node; runs on a thread of its own."""
+    node = NodeSample(client, default_collection_items(client))
+    vb_items = vbucket_items(client)
+    with repairer.timer.stage('sample'):
+        for _ in range(samples):
+            try:
+                found = client.get_random_key()
+            except mc_bin_client.ErrorKeyEnoent:
+                # The node holds no items
+                break
+            node.ops += 1
+            for key in found:
+                _, key = leb128.decode_key(key)
+                hit = matches(key)
+                if hit:
+                    weight = prefixed_weight(repairer, node, key, vb_items)
+                else:
+                    weight = vb_items.get(repairer.get_vbid(key), 0)
+                node.weights.append(weight)
+                node.hits.append(hit)
+    return node
+
+
+def estimate(repairer, samples=1000, confidence=0.95):
+    """Estimate the cid-prefixed docs of the bucket of repairer, taking
+    samples random keys from each node."""
+    if not repairer.kv_nodes:
+        repairer.connect()
+    matches = is_prefixed(repairer.cid)
+    with ThreadPoolExecutor(len(repairer.kv_nodes)) as pool:
+        nodes = list(pool.map(lambda client: sample_node(repairer, client, samples, matches),
+                              repairer.kv_nodes))
+    # Counted here rather than on the pool threads, as op() takes no lock
+    for node in nodes:
+        repairer.reporter.op('sample', node.client, node.ops)
+    return Estimate(nodes, confidence)
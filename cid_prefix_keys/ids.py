@@ -0,0 +1,126 @@
+"""
+Sources of the cid-prefixed doc ids to work on.
+
+The couchbase SDK and asyncio are only imported when the ids are queried,
+so that runs with --index or --ids-from start without them.
+
+With --query-ranges the ids are queried as disjoint ranges of meta().id,
+all at once over the asyncio API of the SDK, so that the query nodes and
+the partitions of the index share the enumeration.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import itertools
+import json
+import sys
+from datetime import timedelta
+
+import leb128
+
+from . import engine
+
+# The characters ids mostly start with after their prefix, which the ranges
+# split evenly; the first and last ranges also take those below and above
+FIRST_CHAR, LAST_CHAR = 0x20, 0x7e
+
+
+def cluster_args(options):
+    """Return the connection string and ClusterOptions of the cluster."""
+    from couchbase.auth import PasswordAuthenticator
+    from couchbase.options import ClusterOptions, TLSVerifyMode
+
+    kv_node = f'{options.host}:{options.port}'
+    tls_verify = options.tls_verify or options.tls_ca is not None
+    cluster_options = ClusterOptions(
+        PasswordAuthenticator(options.username, options.password, cert_path=options.tls_ca),
+        tls_verify=TLSVerifyMode.PEER if tls_verify else TLSVerifyMode.NONE)
+    cluster_options.apply_profile('wan_development')
+    return ('couchbases://' if options.tls else 'couchbase://') + kv_node, cluster_options
+
+
+def query_doc_ids(options):
+    """Query the ids starting with the prefix of options.cid with N1QL.
+
+    With options.cid None, query the ids starting with any control
+    character, i.e. the prefix of any cid below 32."""
+    if getattr(options, 'query_ranges', 1) > 1:
+        import asyncio
+        return asyncio.run(query_doc_id_ranges(options, id_ranges(options.cid, options.query_ranges)))
+    from couchbase.cluster import Cluster
+
+    cluster = Cluster(*cluster_args(options))
+    cluster.wait_until_ready(timedelta(seconds=5))
+    if options.cid is None:
+        condition = 'meta().id < " "'
+    else:
+        condition = 'meta().id like ' + json.dumps(leb128.encode_key('%', options.cid).decode(errors='ignore'))
+    query_result = cluster.query(f'select meta().id from `{options.bucket}` where {condition}')
+    doc_ids = [row['id'] for row in query_result]
+    cluster.close()
+    return doc_ids
+
+
+def split_chars(parts):
+    """Return the characters splitting the ids after a prefix into parts ranges."""
+    chars = LAST_CHAR - FIRST_CHAR + 1
+    parts = min(parts, chars)
+    return [chr(FIRST_CHAR + chars * i // parts) for i in range(1, parts)]
+
+
+def id_ranges(cid, parts):
+    """Return parts disjoint ranges covering the ids with the prefix of cid,
+    or of any cid below engine.NUM_CIDS for None.
+
+    Each range is a list of [low, high) spans of meta().id, one per cid."""
+    bounds = [''] + split_chars(parts) + [None]
+    ranges = []
+    for low, high in zip(bounds, bounds[1:]):
+        spans = []
+        for c in (range(engine.NUM_CIDS) if cid is None else [cid]):
+            prefix = leb128.prefix(c).decode()
+            # The ids with the prefix are below the prefix's successor
+            end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            spans.append((prefix + low, end if high is None else prefix + high))
+        ranges.append(spans)
+    return ranges
+
+
+def range_condition(spans):
+    return ' or '.join(f'(meta().id >= {json.dumps(low)} and meta().id < {json.dumps(high)})'
+                       for low, high in spans)
+
+
+async def query_doc_id_ranges(options, ranges):
+    """Query the ids of each range concurrently and return them all, in
+    the order of the ranges."""
+    import asyncio
+    from acouchbase.cluster import Cluster
+
+    cluster = await Cluster.connect(*cluster_args(options))
+    try:
+        await cluster.wait_until_ready(timedelta(seconds=5))
+
+        async def query_range(spans):
+            query_result = cluster.query(
+                f'select meta().id from `{options.bucket}` where {range_condition(spans)}')
+            return [row['id'] async for row in query_result]
+
+        results = await asyncio.gather(*(query_range(spans) for spans in ranges))
+    finally:
+        await cluster.close()
+    return list(itertools.chain.from_iterable(results))
+
+
+def read_doc_ids(path):
+    """Read ids from path ('-' for stdin), one JSON string per line.
+
+    JSON keeps the control characters of the cid prefix intact."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [json.loads(line) for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Batched persistence confirmation.
+
+PersistenceGate holds back actions, such as deleting the originals of a
+restored document, until the key they depend on is persisted on its active
+node.  Keys are confirmed with one multi-key OBSERVE per node and batch
+rather than a round trip per key.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import time
+
+import memcacheConstants
+
+
+class PersistenceGate(object):
+    """Calls on_persisted(context) once the key of context is persisted.
+
+    Keys queued with submit() are observed once batch_size of them are
+    pending, or on flush(). Keys still not persisted are observed again with
+    exponential backoff until timeout seconds have passed, after which
+    on_failed(context, 'timeout') is called; keys which are gone cause
+    on_failed(context, 'not_found'). client_for_vbid(vbid) returns the
+    MemcachedClient of the active node of vbid."""
+
+    def __init__(self, client_for_vbid, on_persisted, on_failed, batch_size=256,
+                 timeout=30.0, poll_interval=0.01, max_poll_interval=0.5,
+                 on_observe=None):
+        assert batch_size > 0
+        self.client_for_vbid = client_for_vbid
+        self.on_persisted = on_persisted
+        self.on_failed = on_failed
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.on_observe = on_observe
+        self.pending = []
+
+    def submit(self, vbid, key, context):
+        """Queue key, which must carry its collection prefix, for confirmation."""
+        self.pending.append((vbid, key, context))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Wait until every pending key is confirmed or has failed."""
+        pending, self.pending = self.pending, []
+        deadline = time.monotonic() + self.timeout
+        delay = self.poll_interval
+        while pending:
+            pending = self._observe(pending)
+            if not pending:
+                return
+            if time.monotonic() >= deadline:
+                for _, _, context in pending:
+                    self.on_failed(context, 'timeout')
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    def _observe(self, entries):
+        """Observe entries and return those which are not persisted yet."""
+        by_client = {}
+        for entry in entries:
+            by_client.setdefault(self.client_for_vbid(entry[0]), []).append(entry)
+        waiting = []
+        for client, entries in by_client.items():
+            for i in range(0, len(entries), self.batch_size):
+                batch = entries[i:i + self.batch_size]
+                results = client.observe_multi([(vbid, key) for vbid, key, _ in batch])
+                if self.on_observe is not None:
+                    self.on_observe(client)
+                # Keys are answered in the order they were asked for
+                for entry, (_, _, state, _) in zip(batch, results):
+                    if state == memcacheConstants.OBSERVE_PERSISTED:
+                        self.on_persisted(entry[2])
+                    elif state == memcacheConstants.OBSERVE_NOT_PERSISTED:
+                        waiting.append(entry)
+                    else:
+                        self.on_failed(entry[2], 'not_found')
+        return waiting
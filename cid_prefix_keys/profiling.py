@@ -0,0 +1,172 @@
+"""
+Profiling of runs and wall time per stage.
+
+A StageTimer adds up the time spent in each stage of a run: the id query,
+connecting, probing, fetching, adding, deleting and so on.  A Profiler
+additionally runs cProfile, a sampling profiler or tracemalloc over the
+run.  Both are written to a text report.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# 'stages' only times the stages
+PROFILERS = ('stages', 'cprofile', 'sample', 'tracemalloc')
+
+
+class StageTimer(object):
+    """Adds up the wall time and calls of each stage.
+
+    Stages may be timed from several threads, and may nest: e.g. the
+    deletes done on completion of durable adds count towards both."""
+
+    def __init__(self):
+        self.seconds = Counter()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def report(self):
+        lines = [f'{"stage":<12} {"calls":>10} {"seconds":>12} {"mean ms":>10}']
+        for name, seconds in self.seconds.most_common():
+            calls = self.calls[name]
+            lines.append(f'{name:<12} {calls:>10} {seconds:>12.3f} {1000 * seconds / calls:>10.3f}')
+        return '\n'.join(lines) + '\n'
+
+
+class NullTimer(object):
+    """A StageTimer which times nothing."""
+
+    _null = nullcontext()
+
+    def stage(self, name):
+        return self._null
+
+
+NULL_TIMER = NullTimer()
+
+
+class Sampler(object):
+    """Samples the stacks of the non-daemon threads every interval."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            threads = {t.ident: t for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                # The reporting, throttling and writer threads are daemons
+                # and spend their time waiting
+                if thread is None or thread.daemon:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def report(self, top=25):
+        total = sum(self.stacks.values())
+        own, inclusive = Counter(), Counter()
+        for stack, samples in self.stacks.items():
+            own[stack[-1]] += samples
+            for function in set(stack):
+                inclusive[function] += samples
+        lines = [f'{total} samples every {self.interval * 1000:g} ms', '', 'Own samples:']
+        lines += [f'{samples:>8} {100 * samples / total:6.1f}%  {function}'
+                  for function, samples in own.most_common(top)]
+        lines += ['', 'Inclusive samples:']
+        lines += [f'{samples:>8} {100 * samples / total:6.1f}%  {function}'
+                  for function, samples in inclusive.most_common(top)]
+        return '\n'.join(lines) + '\n'
+
+    def write_folded(self, path):
+        """Write the stacks in the folded format of flame graph tools."""
+        with open(path, 'w') as f:
+            for stack, samples in self.stacks.items():
+                f.write(';'.join(stack) + f' {samples}\n')
+
+
+class Profiler(object):
+    """Runs one of PROFILERS and writes its report along with the stages."""
+
+    def __init__(self, mode, path):
+        assert mode in PROFILERS
+        self.mode = mode
+        self.path = path
+        self.timer = StageTimer()
+        self.profile = None
+        self.sampler = None
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == 'sample':
+            self.sampler = Sampler()
+            self.sampler.start()
+        elif self.mode == 'tracemalloc':
+            tracemalloc.start()
+
+    def stop(self):
+        """Stop profiling and write the report to path."""
+        elapsed = time.perf_counter() - self.started
+        with open(self.path, 'w') as f:
+            f.write(f'Profile of {self.mode}, {elapsed:.3f} seconds\n\n')
+            f.write(self.timer.report())
+            if self.mode == 'cprofile':
+                self.profile.disable()
+                self.profile.dump_stats(self.path + '.pstats')
+                out = io.StringIO()
+                pstats.Stats(self.profile, stream=out).sort_stats('cumulative').print_stats(40)
+                f.write('\n' + out.getvalue())
+            elif self.mode == 'sample':
+                self.sampler.stop()
+                self.sampler.write_folded(self.path + '.folded')
+                f.write('\n' + self.sampler.report())
+            elif self.mode == 'tracemalloc':
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                f.write(f'\nPeak traced memory {peak / 2**20:.1f} MiB, '
+                        f'{current / 2**20:.1f} MiB at the end\n\n')
+                for stat in snapshot.statistics('lineno')[:25]:
+                    f.write(f'{stat}\n')
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Periodic progress, rate and ETA reporting.
+
+Counts operations per stage and per node, and every interval prints a
+progress line and/or writes a JSON or Prometheus textfile metrics snapshot.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+METRICS_FORMATS = ('json', 'prometheus')
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def format_rates(stages):
+    return ', '.join('{} {:.0f}/s'.format(stage, s['ops_per_second']) for stage, s in stages.items())
+
+
+class ProgressReporter(object):
+    """Collects per-stage, per-node operation counts and reports them.
+
+    Counting is cheap and always on; the reporting thread only runs once
+    start() is called."""
+
+    def __init__(self, total=None, interval=10.0, stream=None, metrics_file=None,
+                 metrics_format='json', labels=None, node_name=str):
+        assert metrics_format in METRICS_FORMATS
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.metrics_file = metrics_file
+        self.metrics_format = metrics_format
+        self.labels = labels or {}
+        self.node_name = node_name
+        self.processed = 0
+        self.ops = Counter()
+        self.errors = Counter()
+        self.started = time.monotonic()
+        self.last = (self.started, 0, Counter())
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def op(self, stage, node, count=1):
+        """Count ops of stage on node; not thread-safe."""
+        self.ops[stage, node] += count
+
+    def error(self, stage, node):
+        self.errors[stage, node] += 1
+
+    def start(self):
+        self.started = time.monotonic()
+        self.last = (self.started, 0, Counter())
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+            self.report()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.report()
+
+    def snapshot(self):
+        """Return the counters and the rates since the previous snapshot."""
+        now = time.monotonic()
+        processed = self.processed
+        ops = self.ops.copy()
+        errors = self.errors.copy()
+        last_time, last_processed, last_ops = self.last
+        self.last = (now, processed, ops)
+        elapsed = now - self.started
+        dt = max(now - last_time, 1e-9)
+        rate = (processed - last_processed) / dt
+        if not rate and elapsed > 0:
+            rate = processed / elapsed
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(0, self.total - processed) / rate
+        stages = {}
+        nodes = {}
+        for (stage, node), count in ops.items():
+            stats = {'ops': count,
+                     'errors': errors[stage, node],
+                     'ops_per_second': (count - last_ops[stage, node]) / dt}
+            name = self.node_name(node)
+            nodes.setdefault(name, {})[stage] = stats
+            total = stages.setdefault(stage, {'ops': 0, 'errors': 0, 'ops_per_second': 0.0})
+            for k, v in stats.items():
+                total[k] += v
+        return {'timestamp': time.time(),
+                'labels': self.labels,
+                'elapsed_seconds': elapsed,
+                'processed': processed,
+                'total': self.total,
+                'ids_per_second': rate,
+                'eta_seconds': eta,
+                'stages': stages,
+                'nodes': nodes}
+
+    def report(self):
+        snapshot = self.snapshot()
+        if self.stream is not None:
+            self.stream.write(self.format_line(snapshot) + '\n')
+            self.stream.flush()
+        if self.metrics_file is not None:
+            if self.metrics_format == 'json':
+                data = json.dumps(snapshot, indent=2) + '\n'
+            else:
+                data = self.format_prometheus(snapshot)
+            # Replace the file atomically so that readers never see a
+            # partial snapshot
+            tmp = self.metrics_file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.replace(tmp, self.metrics_file)
+
+    def format_line(self, snapshot):
+        words = ['[{}]'.format(format_duration(snapshot['elapsed_seconds']))]
+        if self.labels:
+            words.append(' '.join(f'{k}={v}' for k, v in self.labels.items()))
+        if snapshot['total']:
+            words.append('{}/{} ids ({:.1f}%)'.format(
+                snapshot['processed'], snapshot['total'],
+                100.0 * snapshot['processed'] / snapshot['total']))
+        else:
+            words.append('{} ids'.format(snapshot['processed']))
+        words.append('{:.0f} ids/s'.format(snapshot['ids_per_second']))
+        if snapshot['eta_seconds'] is not None:
+            words.append('ETA ' + format_duration(snapshot['eta_seconds']))
+        ops = sum(s['ops'] for s in snapshot['stages'].values())
+        errors = sum(s['errors'] for s in snapshot['stages'].values())
+        if snapshot['stages']:
+            words.append('| ' + format_rates(snapshot['stages']))
+        for name, stages in snapshot['nodes'].items():
+            # In the order of the totals, which nodes need not share
+            stages = {stage: stages[stage] for stage in snapshot['stages'] if stage in stages}
+            words.append(f'| {name}: ' + format_rates(stages))
+        if ops:
+            words.append('| errors {} ({:.2f}%)'.format(errors, 100.0 * errors / ops))
+        return ' '.join(words)
+
+    def format_prometheus(self, snapshot):
+        def labels(**extra):
+            items = dict(self.labels, **extra)
+            if not items:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in items.items()) + '}'
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f'# HELP cid_repair_{name} {help}')
+            lines.append(f'# TYPE cid_repair_{name} {kind}')
+            for sample_labels, value in samples:
+                lines.append(f'cid_repair_{name}{sample_labels} {value}')
+
+        metric('ids_processed_total', 'counter', 'Doc ids processed.',
+               [(labels(), snapshot['processed'])])
+        if snapshot['total'] is not None:
+            metric('ids', 'gauge', 'Doc ids to process.', [(labels(), snapshot['total'])])
+        metric('ids_per_second', 'gauge', 'Doc ids processed per second.',
+               [(labels(), snapshot['ids_per_second'])])
+        if snapshot['eta_seconds'] is not None:
+            metric('eta_seconds', 'gauge', 'Estimated time to completion.',
+                   [(labels(), snapshot['eta_seconds'])])
+        for name, kind, key, help in (
+                ('ops_total', 'counter', 'ops', 'Operations sent.'),
+                ('errors_total', 'counter', 'errors', 'Operations which failed.'),
+                ('ops_per_second', 'gauge', 'ops_per_second', 'Operations sent per second.')):
+            metric(name, kind, help,
+                   [(labels(stage=stage, node=node), stats[key])
+                    for node, stages in snapshot['nodes'].items()
+                    for stage, stats in stages.items()])
+        return '\n'.join(lines) + '\n'
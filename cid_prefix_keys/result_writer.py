@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Buffered writer of per-document results.
+
+Results are formatted as human-readable text, NDJSON or CSV and written in
+large chunks rather than one print() per operation.  Formatting and writing
+may be moved to a background thread.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import csv
+import io
+import json
+import queue
+import threading
+
+# Verbosity levels
+SUMMARY = 0  # nothing but the summary
+RESULTS = 1  # the outcome of each id: added, deleted, not found, ...
+DETAILS = 2  # also every copy found while probing
+
+FORMATS = ('text', 'ndjson', 'csv')
+
+CSV_COLUMNS = ('event', 'id', 'cid', 'cas', 'flags', 'vb', 'status', 'reason', 'xattrs')
+
+TEXT_LABELS = {
+    'not_found': 'Not found',
+    'got': 'Got',
+    'xattrs': 'XATTRS',
+    'added': 'Added',
+    'already_exists': 'Already exists',
+    'deleted': 'Deleted',
+    'ambiguous': 'Ambiguous',
+    'failed': 'Failed',
+    'changed': 'Changed',
+    'unconfirmed': 'Unconfirmed',
+    'verified': 'Verified',
+    'missing': 'Missing',
+    'mismatched': 'Mismatched',
+}
+
+
+class ResultWriter(object):
+    """Buffered writer of (event, id, fields) records."""
+
+    def __init__(self, stream, fmt='text', verbosity=SUMMARY, background=False,
+                 buffer_size=65536, header=True):
+        assert fmt in FORMATS
+        self.stream = stream
+        self.fmt = fmt
+        self.verbosity = verbosity
+        self.buffer_size = buffer_size
+        self.encoding = getattr(stream, 'encoding', None) or 'utf-8'
+        self.pending = []
+        self.pending_size = 0
+        if fmt == 'csv' and header:
+            self._append(self._format_csv(dict(zip(CSV_COLUMNS, CSV_COLUMNS))))
+        self.queue = None
+        self.thread = None
+        if background:
+            self.queue = queue.Queue(maxsize=65536)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def write(self, level, event, id, **fields):
+        """Record an event about doc id if level is within the verbosity."""
+        if level > self.verbosity:
+            return
+        if self.queue is not None:
+            self.queue.put((event, id, fields))
+        else:
+            self._append(self._format(event, id, fields))
+
+    def flush(self):
+        if self.queue is not None:
+            self.queue.join()
+        self._flush()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+        self._flush()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                self.queue.task_done()
+                return
+            self._append(self._format(*record))
+            if self.queue.empty():
+                self._flush()
+            self.queue.task_done()
+
+    def _append(self, line):
+        # Chunks never exceed buffer_size bytes unless a single line does,
+        # so writers sharing a pipe keep their lines whole.  Ids may hold
+        # characters taking several bytes in UTF-8.
+        size = len(line) if line.isascii() else len(line.encode(self.encoding, 'replace'))
+        if self.pending and self.pending_size + size > self.buffer_size:
+            self._flush()
+        self.pending.append(line)
+        self.pending_size += size
+
+    def _flush(self):
+        if self.pending:
+            self.stream.write(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+        self.stream.flush()
+
+    def _format(self, event, id, fields):
+        if self.fmt == 'ndjson':
+            record = {'event': event, 'id': id}
+            record.update(fields)
+            return json.dumps(record) + '\n'
+        if self.fmt == 'csv':
+            record = {'event': event, 'id': id}
+            record.update(fields)
+            if 'xattrs' in record:
+                record['xattrs'] = json.dumps(record['xattrs'])
+            return self._format_csv(record)
+        words = [TEXT_LABELS.get(event, event), json.dumps(id)]
+        for name, value in fields.items():
+            if name == 'xattrs':
+                value = json.dumps(value, indent=2)
+            words.append(f'{name}: {value}')
+        return ' '.join(words) + '\n'
+
+    def _format_csv(self, record):
+        out = io.StringIO()
+        csv.DictWriter(out, CSV_COLUMNS).writerow(record)
+        return out.getvalue()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Server-pressure-aware throttling.
+
+A background thread polls the stats of every node, on connections of its
+own, and derives the pressure each node is under from its memory use against
+the high watermark, its disk write queue and its ops rate.  Writers call
+wait() before each mutation, which slows them down as a node approaches its
+limits, blocks them while it is over them and lets them speed back up once
+the node has recovered.  A node which stays paused while its stats cannot
+be polled makes the writers waiting for it raise ThrottleError.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import threading
+import time
+
+
+class ThrottleError(Exception):
+    """Writes to a paused node cannot resume, e.g. it stopped answering."""
+
+
+class NodeState(object):
+    """The last known pressure of a node and the throttling it implies."""
+
+    __slots__ = ('client', 'pressure', 'delay', 'resumed', 'last_ops',
+                 'last_time', 'failures', 'error')
+
+    def __init__(self):
+        self.client = None
+        self.pressure = 0.0
+        self.delay = 0.0
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.last_ops = None
+        self.last_time = None
+        # Consecutive polls which failed
+        self.failures = 0
+        # The ThrottleError raised to writers, if any
+        self.error = None
+
+
+class ThrottleMonitor(object):
+    """Throttles writes to the nodes of a cluster by their stats.
+
+    The pressure of a node is the largest of mem_used / ep_mem_high_wat
+    relative to max_mem_ratio, the disk write queue relative to
+    max_disk_queue and, if max_ops is set, the ops rate relative to
+    max_ops.  Below slow_at writes are not delayed; from there up to 1 each
+    write is delayed by up to max_delay seconds; at 1 and above writes are
+    paused until the pressure has dropped below slow_at again.  Once the
+    stats of a paused node failed max_failures polls in a row, its writers
+    raise ThrottleError instead.
+
+    nodes are the keys later passed to wait(); connect(node) must return a
+    new MemcachedClient to poll the stats of node with."""
+
+    def __init__(self, nodes, connect, interval=1.0, max_mem_ratio=0.95,
+                 max_disk_queue=1000000, max_ops=None, slow_at=0.8,
+                 max_delay=0.05, max_failures=5, stream=None, node_name=str):
+        assert 0 < slow_at < 1
+        self.connect = connect
+        self.interval = interval
+        self.max_mem_ratio = max_mem_ratio
+        self.max_disk_queue = max_disk_queue
+        self.max_ops = max_ops
+        self.slow_at = slow_at
+        self.max_delay = max_delay
+        self.max_failures = max_failures
+        self.stream = stream
+        self.node_name = node_name
+        self.states = {node: NodeState() for node in nodes}
+        self.paused_seconds = 0.0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.poll()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        for state in self.states.values():
+            if state.client is not None:
+                state.client.close()
+                state.client = None
+            # Never leave a writer blocked behind a monitor which is gone
+            state.resumed.set()
+        if self.paused_seconds and self.stream is not None:
+            self.stream.write(f'Throttle: writes paused for {self.paused_seconds:.1f}s in total\n')
+            self.stream.flush()
+
+    def wait(self, node):
+        """Block for as long as writes to node should be held back."""
+        state = self.states.get(node)
+        if state is None:
+            return
+        if not state.resumed.is_set():
+            start = time.monotonic()
+            # Wake up every interval, so that a monitor thread which died
+            # cannot leave writers blocked for good
+            while not state.resumed.wait(self.interval):
+                if self.stopping.is_set():
+                    # stop() resumes every node
+                    continue
+                if self.thread is None or not self.thread.is_alive():
+                    state.error = ThrottleError(f'{self.node_name(node)}: throttle monitor stopped')
+                    break
+            self.paused_seconds += time.monotonic() - start
+        if state.error is not None:
+            raise state.error
+        if state.delay:
+            time.sleep(state.delay)
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        for node, state in self.states.items():
+            try:
+                if state.client is None:
+                    state.client = self.connect(node)
+                stats = state.client.stats()
+            except Exception as e:
+                # Keep the last known state and reconnect on the next poll
+                self._log(node, f'stats failed: {e}')
+                if state.client is not None:
+                    state.client.close()
+                    state.client = None
+                state.failures += 1
+                if state.failures >= self.max_failures and not state.resumed.is_set():
+                    state.error = ThrottleError(
+                        f'{self.node_name(node)}: paused, and stats failed {state.failures} '
+                        f'times in a row: {e}')
+                    state.resumed.set()
+                continue
+            state.failures = 0
+            self.update(node, state, stats, time.monotonic())
+
+    def pressure(self, state, stats, now):
+        """Return the pressure a node is under according to its stats."""
+        pressure = 0.0
+        high_wat = int(stats.get('ep_mem_high_wat', 0))
+        if high_wat:
+            pressure = int(stats.get('mem_used', 0)) / high_wat / self.max_mem_ratio
+        if self.max_disk_queue:
+            disk_queue = (int(stats.get('ep_queue_size', 0))
+                          + int(stats.get('ep_flusher_todo', 0)))
+            pressure = max(pressure, disk_queue / self.max_disk_queue)
+        if 'cmd_total_ops' in stats:
+            ops = int(stats['cmd_total_ops'])
+            if self.max_ops and state.last_ops is not None and now > state.last_time:
+                rate = (ops - state.last_ops) / (now - state.last_time)
+                pressure = max(pressure, rate / self.max_ops)
+            state.last_ops, state.last_time = ops, now
+        return pressure
+
+    def update(self, node, state, stats, now):
+        state.pressure = pressure = self.pressure(state, stats, now)
+        paused = not state.resumed.is_set()
+        if pressure >= 1 or (paused and pressure >= self.slow_at):
+            state.delay = 0.0
+            if not paused:
+                state.resumed.clear()
+                self._log(node, f'paused at pressure {pressure:.2f}')
+            return
+        if pressure >= self.slow_at:
+            delay = self.max_delay * (pressure - self.slow_at) / (1 - self.slow_at)
+        else:
+            delay = 0.0
+        if paused:
+            self._log(node, f'resumed at pressure {pressure:.2f}')
+        elif bool(delay) != bool(state.delay):
+            self._log(node, f'{"slowed" if delay else "full speed"} at pressure {pressure:.2f}')
+        state.delay = delay
+        state.resumed.set()
+
+    def _log(self, node, message):
+        if self.stream is not None:
+            self.stream.write(f'Throttle {self.node_name(node)}: {message}\n')
+            self.stream.flush()
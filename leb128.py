@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Collection id key prefixes.
+
+With collections enabled every key on the wire starts with the unsigned
+LEB128 encoding of its collection id.  The encoded prefixes are memoized, so
+that building a key costs a single bytes concatenation.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import functools
+
+# Collection ids are 32 bit, which LEB128 encodes in at most 5 bytes
+MAX_PREFIX_SIZE = 5
+
+
+@functools.lru_cache(maxsize=None)
+def prefix(cid):
+    """Return the LEB128 encoding of cid."""
+    if cid < 0 or cid >= 1 << 32:
+        raise ValueError(f'{cid} is not a valid collection id')
+    output = bytearray()
+    while True:
+        byte = cid & 0x7f
+        cid >>= 7
+        if cid > 0:
+            output.append(byte | 0x80)
+        else:
+            output.append(byte)
+            return bytes(output)
+
+
+def encode_key(key, cid=0):
+    """Prefix key, a str or bytes, with the encoding of cid."""
+    if isinstance(key, str):
+        key = key.encode()
+    return prefix(cid) + key
+
+
+def encode_keys(keys, cid=0):
+    """Prefix each of keys with the encoding of cid."""
+    p = prefix(cid)
+    return [p + (key.encode() if isinstance(key, str) else key) for key in keys]
+
+
+def decode_key(key):
+    """Split a raw key into its collection id and the rest of the key."""
+    cid = 0
+    shift = 0
+    for i in range(min(len(key), MAX_PREFIX_SIZE)):
+        byte = key[i]
+        cid |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return cid, bytes(key[i + 1:])
+        shift += 7
+    raise ValueError(f'{bytes(key)!r} does not start with a collection id')
+
+
+def decode_keys(keys):
+    """Return decode_key() of each of keys."""
+    return [decode_key(key) for key in keys]
@@ -10,8 +10,8 @@ in the file licenses/APL2.txt.
 
 """
 
-import array
 import hmac
+import itertools
 import json
 import random
 import re
@@ -23,13 +23,19 @@ import sys
 import time
 
 from memcacheConstants import REQ_MAGIC_BYTE, RES_MAGIC_BYTE, ALT_REQ_MAGIC_BYTE, ALT_RES_MAGIC_BYTE
-from memcacheConstants import REQ_PKT_FMT, RES_PKT_FMT, ALT_REQ_PKT_FMT, ALT_RES_PKT_FMT, MIN_RECV_PACKET
-from memcacheConstants import SET_PKT_FMT, DEL_PKT_FMT, INCRDECR_RES_FMT
-from memcacheConstants import TOUCH_PKT_FMT, GAT_PKT_FMT, GETL_PKT_FMT
-from memcacheConstants import COMPACT_DB_PKT_FMT
+from memcacheConstants import REQ_PKT_FMT, MIN_RECV_PACKET
+from memcacheConstants import REQ_PKT_STRUCT, RES_PKT_STRUCT, ALT_REQ_PKT_STRUCT, ALT_RES_PKT_STRUCT
 from memcacheConstants import DTYPE_RAW, DTYPE_JSON
+import leb128
 import memcacheConstants
 
+# Smallest value which zero-copy clients send without concatenating it to
+# the request header.
+ZERO_COPY_MIN_SIZE = 16384
+
+# The header formats passed to _sendMsg(), precompiled
+_header_structs = {REQ_PKT_FMT: REQ_PKT_STRUCT}
+
 def parse_address(addr):
     """Parse a host string with optional port number into a
     (host, port, family) triple."""
@@ -55,6 +61,40 @@ def parse_address(addr):
     return host, port, family
 
 
+# SSLContext shared by all clients which are not given one explicitly
+_ssl_context = None
+# (host, port) => (context, session) of the last TLS session to each node
+_ssl_sessions = {}
+
+def create_ssl_context(verify=False, cafile=None, check_hostname=True,
+                       certfile=None, keyfile=None):
+    """Create an SSLContext suitable for MemcachedClient connections.
+
+    Unless verify is set (or a cafile given) the server certificate is not
+    checked. A client certificate may be presented with certfile/keyfile."""
+    if verify or cafile:
+        context = ssl.create_default_context(cafile=cafile)
+        context.check_hostname = check_hostname
+    else:
+        context = ssl._create_unverified_context()
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+def set_ssl_context(context):
+    """Set the SSLContext shared by clients created with use_ssl."""
+    global _ssl_context
+    _ssl_context = context
+    _ssl_sessions.clear()
+
+def get_ssl_context():
+    """Return the shared SSLContext, creating an unverified one if unset."""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = create_ssl_context()
+    return _ssl_context
+
+
 def to_bytes(bytes_or_str):
     if isinstance(bytes_or_str, str):
         value = bytes_or_str.encode()  # uses 'utf-8' for encoding
@@ -170,10 +210,16 @@ class MemcachedClient(object):
     """Simple memcached client."""
 
     vbucketId = 0
+    capture = None
 
-    def __init__(self, host='127.0.0.1', port=11211, family=socket.AF_UNSPEC, use_ssl=False):
+    def __init__(self, host='127.0.0.1', port=11211, family=socket.AF_UNSPEC, use_ssl=False,
+                 zero_copy=False, ssl_context=None, capture=None):
         self.host = host
         self.port = port
+        # When set, values returned by the get family of commands are
+        # memoryviews into the received buffer, and large values are sent
+        # without being concatenated into a new buffer first.
+        self.zero_copy = zero_copy
 
         # Iterate all addresses for the given family; using the first
         # one we can successfully connect to. If none succeed raise
@@ -188,7 +234,13 @@ class MemcachedClient(object):
                 sock.settimeout(10)
                 sock.connect(sockaddr)
                 if use_ssl:
-                    sock = ssl._create_unverified_context().wrap_socket(sock, server_hostname=host)
+                    context = ssl_context or get_ssl_context()
+                    # Resume the last session with this node if there is one
+                    session = None
+                    cached = _ssl_sessions.get((host, port))
+                    if cached is not None and cached[0] is context:
+                        session = cached[1]
+                    sock = context.wrap_socket(sock, server_hostname=host, session=session)
                 self.s = sock
                 break
             except OSError as err:
@@ -201,6 +253,10 @@ class MemcachedClient(object):
             raise sock_error
 
         # self.s.setblocking(0)
+        # An mc_capture.WireCapture recording the frames sent and received
+        self.capture = capture
+        if capture is not None:
+            self.capture_id = capture.opened(*self.s.getpeername()[:2])
         self.r = random.Random()
         self.req_features = set()
         self.features = set()
@@ -210,7 +266,20 @@ class MemcachedClient(object):
 
     def close(self):
         if hasattr(self, 's'):
+            self._saveSslSession()
             self.s.close()
+        if self.capture is not None:
+            self.capture.closed(self.capture_id)
+            self.capture = None
+
+    def _saveSslSession(self):
+        # TLS 1.3 servers send their session tickets after the handshake,
+        # so this is only worth calling once a response has been read.
+        if isinstance(self.s, ssl.SSLSocket) and self.s.session is not None:
+            _ssl_sessions[(self.host, self.port)] = (self.s.context, self.s.session)
+
+    def is_ssl_session_reused(self):
+        return isinstance(self.s, ssl.SSLSocket) and self.s.session_reused
 
     def __del__(self):
         self.close()
@@ -224,28 +293,63 @@ class MemcachedClient(object):
         """Send a request in the alternative format supporing flex framing extras"""
         if collection:
             key = self._encodeCollectionId(key, collection)
+        elif isinstance(key, str):
+            key = key.encode()
+        if isinstance(val, str):
+            val = val.encode()
 
-        msg = struct.pack(ALT_REQ_PKT_FMT, ALT_REQ_MAGIC_BYTE, cmd, len(flex),
-                          len(key), len(extras), dtype, self.vbucketId,
-                          len(flex) + len(key) + len(extras) + len(val),
-                          opaque, cas)
-        self.s.sendall(msg + flex + extras + to_bytes(key) + to_bytes(val))
+        msg = ALT_REQ_PKT_STRUCT.pack(
+            ALT_REQ_MAGIC_BYTE, cmd, len(flex), len(key), len(extras), dtype,
+            self.vbucketId, len(flex) + len(key) + len(extras) + len(val), opaque, cas)
+        self._sendBuffers(msg + flex + extras + key, val)
 
     def _sendMsg(self, cmd, key, val, opaque, extraHeader=b'', cas=0,
                  dtype=0, vbucketId=0,
                  fmt=REQ_PKT_FMT, magic=REQ_MAGIC_BYTE, collection=None):
         if collection is not None:
             key = self._encodeCollectionId(key, collection)
-
-        msg=struct.pack(fmt, magic,
+        elif isinstance(key, str):
+            key = key.encode()
+        if isinstance(val, str):
+            val = val.encode()
+
+        header = _header_structs.get(fmt)
+        if header is None:
+            header = _header_structs[fmt] = struct.Struct(fmt)
+        msg = header.pack(magic,
             cmd, len(key), len(extraHeader), dtype, vbucketId,
                 len(key) + len(extraHeader) + len(val), opaque, cas)
-        self.s.sendall(msg + extraHeader + to_bytes(key) + to_bytes(val))
+        self._sendBuffers(msg + extraHeader + key, val)
+
+    def _sendBuffers(self, header, val):
+        if self.capture is not None:
+            self.capture.request(self.capture_id, header, val)
+        if self.zero_copy and len(val) >= ZERO_COPY_MIN_SIZE and not isinstance(self.s, ssl.SSLSocket):
+            # Hand large values to the socket as they are rather than
+            # copying them into a single request buffer.  SSL sockets have
+            # no sendmsg(), and copy the value when encrypting it anyway.
+            self._sendmsgAll([header, val])
+        else:
+            self.s.sendall(header + val)
+
+    def _sendmsgAll(self, buffers):
+        """Write all of buffers in one sendmsg() call, or more if it only
+        sends part of them."""
+        buffers = [memoryview(b).cast('B') for b in buffers]
+        while buffers:
+            sent = self.s.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = buffers[0][sent:]
 
     def _socketRecv(self, amount):
         return self.s.recv(amount)
 
-    def _recvMsg(self):
+    def _socketRecvInto(self, buf):
+        return self.s.recv_into(buf)
+
+    def _recvMsg(self, view=False):
         response = b''
         while len(response) < MIN_RECV_PACKET:
             data = self._socketRecv(MIN_RECV_PACKET - len(response))
@@ -254,54 +358,88 @@ class MemcachedClient(object):
             response += data
         assert len(response) == MIN_RECV_PACKET
 
-        (magic, ) = struct.unpack(">B", response[0:1])
+        magic = response[0]
         assert magic in (RES_MAGIC_BYTE, ALT_RES_MAGIC_BYTE), "Got magic: {:#x}".format(magic)
 
         if magic == RES_MAGIC_BYTE:
             (_, cmd, keylen, extralen, dtype, errcode, remaining, opaque,
-             cas) = struct.unpack(RES_PKT_FMT, response)
+             cas) = RES_PKT_STRUCT.unpack(response)
             framing_extras_len = 0
         elif magic == ALT_RES_MAGIC_BYTE:
             (_, cmd, framing_extras_len, keylen, extralen, dtype, errcode,
-             remaining, opaque, cas) = struct.unpack(ALT_RES_PKT_FMT, response)
-
-        rv = b''
-        while remaining > 0:
-            data = self._socketRecv(remaining)
-            if data == b'':
-                raise EOFError("Got empty data (remote died?).")
-            rv += data
-            remaining -= len(data)
+             remaining, opaque, cas) = ALT_RES_PKT_STRUCT.unpack(response)
+
+        if view:
+            # Receive the body into a single buffer and return a view of it
+            rv = memoryview(bytearray(remaining))
+            received = 0
+            while received < remaining:
+                amount = self._socketRecvInto(rv[received:])
+                if amount == 0:
+                    raise EOFError("Got empty data (remote died?).")
+                received += amount
+        else:
+            rv = b''
+            while remaining > 0:
+                data = self._socketRecv(remaining)
+                if data == b'':
+                    raise EOFError("Got empty data (remote died?).")
+                rv += data
+                remaining -= len(data)
+
+        if self.capture is not None:
+            self.capture.response(self.capture_id, response, rv,
+                                  framing_extras_len + extralen + keylen)
 
         # TODO: Skip flex framing extras in response for now
         rv = rv[framing_extras_len:]
 
         return cmd, errcode, opaque, cas, keylen, extralen, rv
 
-    def _handleKeyedResponse(self, myopaque):
-        cmd, errcode, opaque, cas, keylen, extralen, rv = self._recvMsg()
+    def _handleStatusResponse(self, myopaque, view=False):
+        """Receive a response, returning its status instead of raising."""
+        cmd, errcode, opaque, cas, keylen, extralen, rv = self._recvMsg(view)
         assert myopaque is None or opaque == myopaque, \
             "expected opaque %x, got %x" % (myopaque, opaque)
-        if errcode != 0:
-            err_context = rv.decode(errors="backslashreplace")
-            if self.error_map is None:
-                msg = err_context
-            else:
-                err = self.error_map['errors'].get(errcode)
-                msg = "{name} : {desc} : {rv}".format(rv=err_context, **err)
+        return cmd, errcode, opaque, cas, keylen, extralen, rv
+
+    def _makeError(self, errcode, rv):
+        err_context = bytes(rv).decode(errors="backslashreplace")
+        if self.error_map is None:
+            msg = err_context
+        else:
+            err = self.error_map['errors'].get(errcode)
+            msg = "{name} : {desc} : {rv}".format(rv=err_context, **err)
+        return MemcachedError(errcode, msg)
 
-            raise MemcachedError(errcode,  msg)
+    def _handleKeyedResponse(self, myopaque, view=False):
+        cmd, errcode, opaque, cas, keylen, extralen, rv = self._handleStatusResponse(myopaque, view)
+        if errcode != 0:
+            raise self._makeError(errcode, rv)
         return cmd, opaque, cas, keylen, extralen, rv
 
-    def _handleSingleResponse(self, myopaque):
-        cmd, opaque, cas, keylen, extralen, data = self._handleKeyedResponse(myopaque)
+    def _handleSingleResponse(self, myopaque, view=False):
+        cmd, opaque, cas, keylen, extralen, data = self._handleKeyedResponse(myopaque, view)
         return opaque, cas, data
 
-    def _doCmd(self, cmd, key, val, extraHeader=b'', cas=0, collection=None):
-        """Send a command and await its response."""
+    def _doCmd(self, cmd, key, val, extraHeader=b'', cas=0, collection=None,
+               view=False):
+        """Send a command and await its response.
+
+        If view is set the response body is returned as a memoryview."""
         opaque=self.r.randint(0, 2**32)
         self._sendCmd(cmd, key, val, opaque, extraHeader, cas, collection)
-        return self._handleSingleResponse(opaque)
+        return self._handleSingleResponse(opaque, view)
+
+    def _doStatusCmd(self, cmd, key, val, extraHeader=b'', cas=0, collection=None,
+                     view=False):
+        """Send a command and await its response without raising on failure.
+
+        Returns a (status, cas, keylen, extralen, data) tuple."""
+        opaque=self.r.randint(0, 2**32)
+        self._sendCmd(cmd, key, val, opaque, extraHeader, cas, collection)
+        cmd, errcode, opaque, cas, keylen, extralen, rv = self._handleStatusResponse(opaque, view)
+        return errcode, cas, keylen, extralen, rv
 
     def _doAltCmd(self, cmd, flex, key, val, extraHeader=b'', cas=0,
                   collection=None):
@@ -313,12 +451,12 @@ class MemcachedClient(object):
         return self._handleSingleResponse(opaque)
 
     def _mutate(self, cmd, key, exp, flags, cas, val, collection):
-        return self._doCmd(cmd, key, val, struct.pack(SET_PKT_FMT, flags, exp),
+        return self._doCmd(cmd, key, val, memcacheConstants.SET_PKT_STRUCT.pack(flags, exp),
             cas, collection)
 
     def _mutateDurable(self, cmd, key, exp, flags, cas, val, level, timeout, collection):
         flex = self._encodeDurabilityFlex(level, timeout)
-        return self._doAltCmd(cmd, flex, key, val, struct.pack(SET_PKT_FMT, flags, exp),
+        return self._doAltCmd(cmd, flex, key, val, memcacheConstants.SET_PKT_STRUCT.pack(flags, exp),
                            cas, collection)
 
     def _cat(self, cmd, key, cas, val, collection):
@@ -336,6 +474,7 @@ class MemcachedClient(object):
         if self.is_xerror_supported():
             self.error_map = self.get_error_map()
 
+        self._saveSslSession()
         return resp
 
     def append(self, key, value, cas=0, collection=None):
@@ -346,9 +485,9 @@ class MemcachedClient(object):
 
     def __incrdecr(self, cmd, key, amt, init, exp, collection):
         something, cas, val=self._doCmd(cmd, key, '',
-            struct.pack(memcacheConstants.INCRDECR_PKT_FMT, amt, init, exp),
+            memcacheConstants.INCRDECR_PKT_STRUCT.pack(amt, init, exp),
             collection=collection)
-        return struct.unpack(INCRDECR_RES_FMT, val)[0], cas
+        return memcacheConstants.INCRDECR_RES_STRUCT.unpack(val)[0], cas
 
     def incr(self, key, amt=1, init=0, exp=0, collection=None):
         """Increment or create the named counter."""
@@ -361,9 +500,9 @@ class MemcachedClient(object):
     def _doMetaCmd(self, cmd, key, value, cas, exp, flags, seqno, remote_cas, collection, options=None):
         extra = b''
         if options is not None:
-            extra = struct.pack('>IIQQI', flags, exp, seqno, remote_cas, options)
+            extra = memcacheConstants.META_OPTIONS_PKT_STRUCT.pack(flags, exp, seqno, remote_cas, options)
         else:
-            extra = struct.pack('>IIQQ', flags, exp, seqno, remote_cas)
+            extra = memcacheConstants.META_PKT_STRUCT.pack(flags, exp, seqno, remote_cas)
         return self._doCmd(cmd, key, value, extra, cas, collection)
 
     def set(self, key, exp, flags, val, collection=None):
@@ -413,7 +552,7 @@ class MemcachedClient(object):
     
     def add_with_dtype(self, key, exp, flags, val, dtype, collection=None):
         opaque = self.r.randint(0, 2**32)
-        extraHeader = struct.pack(SET_PKT_FMT, flags, exp)
+        extraHeader = memcacheConstants.SET_PKT_STRUCT.pack(flags, exp)
         self._sendMsg(memcacheConstants.CMD_ADD, key, val, opaque, extraHeader=extraHeader,
                       dtype=dtype, vbucketId=self.vbucketId, collection=collection)
         return self._handleSingleResponse(opaque)
@@ -426,6 +565,25 @@ class MemcachedClient(object):
         return self._mutateDurable(memcacheConstants.CMD_ADD, key, exp, flags,
                                    0, val, level, timeout, collection)
 
+    def send_add_durable(self, key, exp, flags, val, opaque,
+                         level=memcacheConstants.DURABILITY_LEVEL_MAJORITY,
+                         timeout=None, dtype=0, collection=None):
+        """Send a durable add without awaiting its response.
+
+        Together with recv_status() this allows many durable writes to be
+        kept in flight on one connection."""
+        flex = self._encodeDurabilityFlex(level, timeout)
+        self._sendAltCmd(memcacheConstants.CMD_ADD, flex, key, val, opaque,
+                         memcacheConstants.SET_PKT_STRUCT.pack(flags, exp), dtype=dtype,
+                         collection=collection)
+
+    def recv_status(self):
+        """Receive the next response without raising on failure.
+
+        Returns a (opaque, status, cas, data) tuple."""
+        cmd, errcode, opaque, cas, keylen, extralen, rv = self._handleStatusResponse(None)
+        return opaque, errcode, cas, rv
+
     def addWithMeta(self, key, value, exp, flags, seqno, remote_cas, collection=None):
         return self._doMetaCmd(memcacheConstants.CMD_ADD_WITH_META,
                                key, value, 0, exp, flags, seqno, remote_cas, collection)
@@ -445,35 +603,88 @@ class MemcachedClient(object):
 
     def observe(self, key, vbucket, collection=None):
         """Observe a key for persistence and replication."""
-        value = struct.pack('>HH', vbucket, len(key)) + key
-        opaque, cas, data = self._doCmd(memcacheConstants.CMD_OBSERVE, '', value, collection=collection)
+        if collection is not None:
+            key = self._encodeCollectionId(key, collection)
+        opaque, cas, results = self._observe([(vbucket, key)])
         rep_time = (cas & 0xFFFFFFFF)
         persist_time =  (cas >> 32) & 0xFFFFFFFF
-        persisted = struct.unpack('>B', data[4+len(key)])[0]
+        persisted = results[0][2]
         return opaque, rep_time, persist_time, persisted
 
+    def observe_multi(self, keys):
+        """Observe many (vbucket, key) pairs in a single request.
+
+        Keys must already carry their collection prefix, if any. Returns a
+        list of (vbucket, key, keystate, cas) in the order of the response,
+        keystate being one of the memcacheConstants.OBSERVE_* states."""
+        return self._observe(keys)[2]
+
+    def _observe(self, keys):
+        value = bytearray()
+        for vbucket, key in keys:
+            key = to_bytes(key)
+            value += memcacheConstants.OBSERVE_KEY_STRUCT.pack(vbucket, len(key))
+            value += key
+        opaque, cas, data = self._doCmd(memcacheConstants.CMD_OBSERVE, '', bytes(value))
+        results = []
+        pos = 0
+        while pos < len(data):
+            vbucket, keylen = memcacheConstants.OBSERVE_KEY_STRUCT.unpack_from(data, pos)
+            pos += memcacheConstants.OBSERVE_KEY_STRUCT.size
+            key = bytes(data[pos:pos + keylen])
+            pos += keylen
+            keystate, key_cas = memcacheConstants.OBSERVE_RES_STRUCT.unpack_from(data, pos)
+            pos += memcacheConstants.OBSERVE_RES_STRUCT.size
+            results.append((vbucket, key, keystate, key_cas))
+        return opaque, cas, results
+
     def __parseGet(self, data, klen=0):
-        flags=struct.unpack(memcacheConstants.GET_RES_FMT, data[-1][:4])[0]
+        flags=memcacheConstants.GET_RES_STRUCT.unpack_from(data[-1])[0]
         return flags, data[1], data[-1][4 + klen:]
 
     def get(self, key, collection=None):
         """Get the value for a given key within the memcached server."""
-        parts=self._doCmd(memcacheConstants.CMD_GET, key, '', collection=collection)
+        parts=self._doCmd(memcacheConstants.CMD_GET, key, '', collection=collection,
+                          view=self.zero_copy)
         return self.__parseGet(parts)
 
+    def get_status(self, key, collection=None):
+        """Get the value for a given key without raising if the lookup fails.
+
+        Returns a (status, flags, cas, value) tuple. On failure flags is 0 and
+        value holds the error context sent by the server."""
+        status, cas, keylen, extralen, data = self._doStatusCmd(
+            memcacheConstants.CMD_GET, key, '', collection=collection,
+            view=self.zero_copy)
+        if status != memcacheConstants.ERR_SUCCESS:
+            return status, 0, cas, data
+        flags = memcacheConstants.GET_RES_STRUCT.unpack_from(data)[0]
+        return status, flags, cas, data[extralen + keylen:]
+
+    try_get = get_status
+
     def getMeta(self, key, collection=None):
         """Get the metadata for a given key within the memcached server."""
         opaque, cas, data = self._doCmd(memcacheConstants.CMD_GET_META, key, '', collection=collection)
-        deleted = struct.unpack('>I', data[0:4])[0]
-        flags = struct.unpack('>I', data[4:8])[0]
-        exp = struct.unpack('>I', data[8:12])[0]
-        seqno = struct.unpack('>Q', data[12:20])[0]
+        deleted, flags, exp, seqno = memcacheConstants.GET_META_RES_STRUCT.unpack_from(data)
         return (deleted, flags, exp, seqno, cas)
 
+    def get_meta_status(self, key, collection=None):
+        """Get the metadata for a given key without raising if the lookup fails.
+
+        Returns a (status, deleted, flags, exp, seqno, cas) tuple; the
+        metadata fields are 0 unless status is ERR_SUCCESS."""
+        status, cas, keylen, extralen, data = self._doStatusCmd(
+            memcacheConstants.CMD_GET_META, key, '', collection=collection)
+        if status != memcacheConstants.ERR_SUCCESS:
+            return status, 0, 0, 0, 0, cas
+        deleted, flags, exp, seqno = memcacheConstants.GET_META_RES_STRUCT.unpack_from(data)
+        return status, deleted, flags, exp, seqno, cas
+
     def getl(self, key, exp=15, collection=None):
         """Get the value for a given key within the memcached server."""
         parts=self._doCmd(memcacheConstants.CMD_GET_LOCKED, key, '',
-            struct.pack(memcacheConstants.GETL_PKT_FMT, exp), collection=collection)
+            memcacheConstants.GETL_PKT_STRUCT.pack(exp), collection=collection)
         return self.__parseGet(parts)
 
     def cas(self, key, exp, flags, oldVal, val, collection=None):
@@ -484,22 +695,36 @@ class MemcachedClient(object):
     def touch(self, key, exp, collection=None):
         """Touch a key in the memcached server."""
         return self._doCmd(memcacheConstants.CMD_TOUCH, key, '',
-            struct.pack(memcacheConstants.TOUCH_PKT_FMT, exp), collection=collection)
+            memcacheConstants.TOUCH_PKT_STRUCT.pack(exp), collection=collection)
 
     def gat(self, key, exp, collection=None):
         """Get the value for a given key and touch it within the memcached server."""
         parts=self._doCmd(memcacheConstants.CMD_GAT, key, '',
-            struct.pack(memcacheConstants.GAT_PKT_FMT, exp), collection=collection)
+            memcacheConstants.GAT_PKT_STRUCT.pack(exp), collection=collection)
         return self.__parseGet(parts)
 
     def getr(self, key, collection=None):
         """Get the value for a given key in a replica vbucket within the memcached server."""
-        parts=self._doCmd(memcacheConstants.CMD_GET_REPLICA, key, '', collection=collection)
+        parts=self._doCmd(memcacheConstants.CMD_GET_REPLICA, key, '', collection=collection,
+                          view=self.zero_copy)
         return self.__parseGet(parts, len(key))
 
+    def getr_status(self, key, collection=None):
+        """Get the value for a given key in a replica vbucket without raising
+        if the lookup fails.
+
+        Returns a (status, flags, cas, value) tuple like get_status()."""
+        status, cas, keylen, extralen, data = self._doStatusCmd(
+            memcacheConstants.CMD_GET_REPLICA, key, '', collection=collection,
+            view=self.zero_copy)
+        if status != memcacheConstants.ERR_SUCCESS:
+            return status, 0, cas, data
+        flags = memcacheConstants.GET_RES_STRUCT.unpack_from(data)[0]
+        return status, flags, cas, data[extralen + keylen:]
+
     def subdoc_get(self, key, path, flags, collection=None):
         path = to_bytes(path)
-        extras = struct.pack('>HB', len(path), flags)
+        extras = memcacheConstants.SUBDOC_PKT_STRUCT.pack(len(path), flags)
         parts = self._doCmd(memcacheConstants.CMD_SUBDOC_GET, key, path,
                             extras, collection=collection)
         return json.loads(parts[-1])
@@ -548,14 +773,14 @@ class MemcachedClient(object):
     def set_param(self, vbucket, key, val, type):
         print("setting param:", key, val)
         self.vbucketId = vbucket
-        type = struct.pack(memcacheConstants.SET_PARAM_FMT, type)
+        type = memcacheConstants.SET_PARAM_STRUCT.pack(type)
         return self._doCmd(memcacheConstants.CMD_SET_PARAM, key, val, type)
 
     def set_vbucket_state(self, vbucket, stateName):
         assert isinstance(vbucket, int)
         self.vbucketId = vbucket
-        state = struct.pack(memcacheConstants.VB_SET_PKT_FMT,
-                            memcacheConstants.VB_STATE_NAMES[stateName])
+        state = memcacheConstants.VB_SET_PKT_STRUCT.pack(
+            memcacheConstants.VB_STATE_NAMES[stateName])
         return self._doCmd(memcacheConstants.CMD_SET_VBUCKET_STATE, '', '',
                            state)
 
@@ -565,8 +790,8 @@ class MemcachedClient(object):
         assert isinstance(purgeBeforeSeq, int)
         assert isinstance(dropDeletes, int)
         self.vbucketId = vbucket
-        compact = struct.pack(memcacheConstants.COMPACT_DB_PKT_FMT,
-                            purgeBeforeTs, purgeBeforeSeq, dropDeletes)
+        compact = memcacheConstants.COMPACT_DB_PKT_STRUCT.pack(
+            purgeBeforeTs, purgeBeforeSeq, dropDeletes)
         return self._doCmd(memcacheConstants.CMD_COMPACT_DB, '', '',
                            compact)
 
@@ -587,25 +812,39 @@ class MemcachedClient(object):
         """Get values for any available keys in the given iterable.
 
         Returns a dict of matched keys to their values."""
-        opaqued=dict(enumerate(keys))
-        terminal=len(opaqued)+10
-        # Send all of the keys in quiet
-        for k,v in opaqued.items():
-            self._sendCmd(memcacheConstants.CMD_GETQ, v, '', k, collection=collection)
+        return dict(self.get_stream(keys, collection=collection))
 
-        self._sendCmd(memcacheConstants.CMD_NOOP, '', '', terminal)
-
-        # Handle the response
-        rv={}
-        done=False
-        while not done:
-            opaque, cas, data=self._handleSingleResponse(None)
-            if opaque != terminal:
-                rv[opaqued[opaque]]=self.__parseGet((opaque, cas, data))
-            else:
-                done=True
+    def get_stream(self, keys, window=64, collection=None):
+        """Get values for any available keys in the given iterable.
 
-        return rv
+        Yields (key, (flags, cas, value)) for each key found, in the order
+        of the responses.  At most window requests are in flight at a time,
+        so neither end blocks on a full socket buffer and only the values
+        not yet consumed are held in memory."""
+        keys = iter(keys)
+        inflight = {}
+        opaque = 0
+        try:
+            while True:
+                for key in itertools.islice(keys, window - len(inflight)):
+                    self._sendCmd(memcacheConstants.CMD_GET, key, '', opaque, collection=collection)
+                    inflight[opaque] = key
+                    opaque = (opaque + 1) & 0xffffffff
+                if not inflight:
+                    return
+                _, errcode, ropaque, cas, _, _, data = self._handleStatusResponse(None, self.zero_copy)
+                key = inflight.pop(ropaque)
+                if errcode == memcacheConstants.ERR_KEY_ENOENT:
+                    continue
+                if errcode != memcacheConstants.ERR_SUCCESS:
+                    raise self._makeError(errcode, data)
+                yield key, self.__parseGet((ropaque, cas, data))
+        except (MemcachedError, GeneratorExit):
+            # Keep the connection usable when a get fails or the caller
+            # stops early
+            for _ in range(len(inflight)):
+                self._handleStatusResponse(None)
+            raise
 
     def setMulti(self, exp, flags, items, collection=None):
         """Multi-set (using setq).
@@ -618,7 +857,7 @@ class MemcachedClient(object):
 
         opaqued=dict(enumerate(items))
         terminal=len(opaqued)+10
-        extra=struct.pack(SET_PKT_FMT, flags, exp)
+        extra=memcacheConstants.SET_PKT_STRUCT.pack(flags, exp)
 
         # Send all of the keys in quiet
         for opaque,kv in opaqued.items():
@@ -687,12 +926,16 @@ class MemcachedClient(object):
         return rv
 
     def get_random_key(self):
+        """Get a random key of the default collection and its value.
+
+        Returns a dict of the key to the value, empty if the server sent no
+        key. With collections enabled the key carries its collection id."""
         opaque=self.r.randint(0, 2**32)
         self._sendCmd(memcacheConstants.CMD_GET_RANDOM_KEY, '', '', opaque)
         cmd, opaque, cas, klen, extralen, data = self._handleKeyedResponse(None)
         rv = {}
         if klen:
-            rv[data[4:klen+4]] = data[klen:]
+            rv[data[extralen:extralen + klen]] = data[extralen + klen:]
         return rv
 
     def noop(self):
@@ -715,7 +958,7 @@ class MemcachedClient(object):
     def flush(self, timebomb=0):
         """Flush all storage in a memcached instance."""
         return self._doCmd(memcacheConstants.CMD_FLUSH, '', '',
-            struct.pack(memcacheConstants.FLUSH_PKT_FMT, timebomb))
+            memcacheConstants.FLUSH_PKT_STRUCT.pack(timebomb))
 
     def bucket_select(self, name):
         return self._doCmd(memcacheConstants.CMD_SELECT_BUCKET, name, '')
@@ -805,7 +1048,7 @@ class MemcachedClient(object):
     # Collections on the wire uses a varint encoding for the collection-ID
     # A simple unsigned_leb128 encoded is used:
     #    https://en.wikipedia.org/wiki/LEB128
-    # @return a string with the binary encoding
+    # @return bytes with the binary encoding
     def _encodeCollectionId(self, key, collection):
         if not self.is_collections_supported():
                 raise RuntimeError("Collections are not enabled")
@@ -821,19 +1064,7 @@ class MemcachedClient(object):
                 print("name API expects \"scope.collection\" as the key")
                 raise e
 
-        output = array.array('B', [0])
-        while collection > 0:
-            byte = collection & 0xFF
-            collection >>= 7
-            # collection has more bits?
-            if collection > 0:
-                # Set the 'continue' bit of this byte
-                byte |= 0x80
-                output[-1] = byte
-                output.append(0)
-            else:
-                output[-1] = byte
-        return output.tobytes().decode(errors='ignore') + key
+        return leb128.encode_key(to_bytes(key), collection)
 
     # Maintain a map of 'scope.collection' => 'collection-id'
     def _update_collection_map(self, manifest):
@@ -855,6 +1086,6 @@ class MemcachedClient(object):
         # 2nd byte: level
         # Optional 3rd and 4th bytes: Timeout.
         if timeout:
-            return struct.pack(">BBH", ((1<<4) | 3), level, timeout)
+            return memcacheConstants.DURABILITY_TIMEOUT_FRAME_STRUCT.pack(((1<<4) | 3), level, timeout)
         else:
-            return struct.pack(">BB", ((1<<4) | 1), level)
+            return memcacheConstants.DURABILITY_FRAME_STRUCT.pack(((1<<4) | 1), level)
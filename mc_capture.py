@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Capture and replay of memcached binary protocol traffic.
+
+A WireCapture given to MemcachedClient records every request and response
+frame of the client, timestamped, to a compact binary file.  Several
+clients, on several threads, may share one capture.  The documents sent
+and the values of responses are left out unless asked for; SASL payloads
+always are.
+
+  python mc_capture.py summary FILE
+      the op mix of a capture, and the latency of each opcode
+
+  python mc_capture.py replay FILE --port 12000 [--speed 10]
+      send the recorded requests again, to a stand-in server such as
+      mc_fake_server.py, and compare its latencies and statuses with the
+      recorded ones
+
+The replay opens one connection per recorded one.  The recorded nodes are
+mapped, in address order, to consecutive ports of the stand-in.  Each
+request is sent at its recorded time divided by --speed, or as soon as
+possible with --speed 0, but never before the responses which had arrived
+on its connection when it was recorded.  This keeps request/response
+exchanges and pipelined windows as they were.  Omitted values are
+replaced by filler of the recorded size, and SASL PLAIN is redone with
+the credentials of the replay.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import ipaddress
+import socket
+import struct
+import threading
+import time
+from argparse import ArgumentParser
+from collections import Counter, defaultdict, deque
+
+import memcacheConstants
+from memcacheConstants import REQ_MAGIC_BYTE, REQ_PKT_STRUCT, MIN_RECV_PACKET, DTYPE_JSON
+
+FILE_MAGIC = b'MCCAP\x00\x00\x01'
+
+# kind, connection, nanoseconds since the capture started, payload length
+RECORD_STRUCT = struct.Struct('>BIQI')
+
+# Record kinds; the payload of OPENED is the peer address as host:port,
+# those of REQUEST and RESPONSE a frame
+OPENED, REQUEST, RESPONSE, CLOSED = range(4)
+
+# The fields at the same offsets in the headers of all request and
+# response formats: magic, opcode, datatype, vbucket or status, body
+# length and opaque
+HEADER_STRUCT = struct.Struct('>BB3xBHII8x')
+
+# Requests whose values are never captured
+SECRET_COMMANDS = {memcacheConstants.CMD_SASL_AUTH, memcacheConstants.CMD_SASL_STEP}
+
+# Requests whose values are documents, only captured when asked for; the
+# values of other requests, e.g. the features of HELLO, are needed to
+# replay them
+DOCUMENT_COMMANDS = {memcacheConstants.CMD_SET, memcacheConstants.CMD_ADD,
+                     memcacheConstants.CMD_REPLACE, memcacheConstants.CMD_APPEND,
+                     memcacheConstants.CMD_PREPEND, memcacheConstants.CMD_SETQ,
+                     memcacheConstants.CMD_ADDQ, memcacheConstants.CMD_SET_WITH_META,
+                     memcacheConstants.CMD_SETQ_WITH_META, memcacheConstants.CMD_ADD_WITH_META,
+                     memcacheConstants.CMD_ADDQ_WITH_META}
+
+
+class WireCapture(object):
+    """Writes the frames of MemcachedClients to a capture file."""
+
+    def __init__(self, path, values=False):
+        self.f = open(path, 'wb')
+        self.f.write(FILE_MAGIC)
+        # Whether to capture the documents sent and the values of the
+        # responses, or only the headers, extras and keys of their frames
+        self.values = values
+        self.started = time.perf_counter_ns()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def _write(self, kind, conn, payload):
+        elapsed = time.perf_counter_ns() - self.started
+        with self.lock:
+            # Clients may outlive the capture
+            if not self.f.closed:
+                self.f.write(RECORD_STRUCT.pack(kind, conn, elapsed, len(payload)))
+                self.f.write(payload)
+
+    def opened(self, host, port):
+        """Record a new connection to host:port and return its id."""
+        with self.lock:
+            conn = self.next_id
+            self.next_id += 1
+        self._write(OPENED, conn, f'{host}:{port}'.encode())
+        return conn
+
+    def closed(self, conn):
+        self._write(CLOSED, conn, b'')
+
+    def request(self, conn, header, value):
+        """Record a request; header holds everything up to the value."""
+        opcode = header[1]
+        if opcode in SECRET_COMMANDS or (opcode in DOCUMENT_COMMANDS and not self.values):
+            self._write(REQUEST, conn, bytes(header))
+        else:
+            self._write(REQUEST, conn, bytes(header) + bytes(value))
+
+    def response(self, conn, header, body, value_offset):
+        """Record a response; its value starts at value_offset of body."""
+        if self.values:
+            self._write(RESPONSE, conn, header + bytes(body))
+        else:
+            self._write(RESPONSE, conn, header + bytes(body[:value_offset]))
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+def read_capture(path):
+    """Yield the (kind, conn, nanoseconds, payload) records of a capture."""
+    with open(path, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        while True:
+            header = f.read(RECORD_STRUCT.size)
+            if len(header) < RECORD_STRUCT.size:
+                return
+            kind, conn, ns, length = RECORD_STRUCT.unpack(header)
+            yield kind, conn, ns, f.read(length)
+
+
+class Session(object):
+    """The traffic of one recorded connection."""
+
+    def __init__(self, address, opened):
+        self.address = address
+        self.opened = opened
+        # (ns, responses received before it, frame)
+        self.requests = []
+        # (ns, frame)
+        self.responses = []
+
+
+def load_sessions(path):
+    """Return the Sessions of a capture, in the order they were opened."""
+    sessions = {}
+    for kind, conn, ns, payload in read_capture(path):
+        if kind == OPENED:
+            host, _, port = payload.decode().rpartition(':')
+            sessions[conn] = Session((host, int(port)), ns)
+        elif kind == REQUEST:
+            session = sessions[conn]
+            session.requests.append((ns, len(session.responses), payload))
+        elif kind == RESPONSE:
+            sessions[conn].responses.append((ns, payload))
+    return list(sessions.values())
+
+
+class OpStats(object):
+    """Latencies and statuses by opcode."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+
+    def add(self, opcode, status, latency):
+        self.latencies[opcode].append(latency)
+        self.statuses[opcode][status] += 1
+
+    def update(self, other):
+        for opcode, latencies in other.latencies.items():
+            self.latencies[opcode] += latencies
+            self.statuses[opcode].update(other.statuses[opcode])
+
+
+def recorded_stats(session):
+    """Return the OpStats of the recorded exchanges of session."""
+    stats = OpStats()
+    events = sorted([(ns, 0, frame) for ns, _, frame in session.requests] +
+                    [(ns, 1, frame) for ns, frame in session.responses])
+    # opaque => [(opcode, ns)] of the requests awaiting a response
+    pending = defaultdict(deque)
+    for ns, is_response, frame in events:
+        _, opcode, _, status, _, opaque = HEADER_STRUCT.unpack_from(frame)
+        if not is_response:
+            pending[opaque].append((opcode, ns))
+        elif pending[opaque]:
+            opcode, sent = pending[opaque].popleft()
+            stats.add(opcode, status, ns - sent)
+    return stats
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+# Opcode => name; memcacheConstants.COMMAND_NAMES keeps the last of the
+# names sharing an opcode, e.g. CMD_SYNC_EVENT_REPLICATED for CMD_DELETE
+COMMAND_NAMES = {}
+for name, value in vars(memcacheConstants).items():
+    if name.startswith('CMD_'):
+        COMMAND_NAMES.setdefault(value, name[4:])
+
+
+def command_name(opcode):
+    return COMMAND_NAMES.get(opcode, f'{opcode:#x}')
+
+
+def format_statuses(statuses):
+    return ' '.join(f'{status:#x}:{count}' for status, count in sorted(statuses.items()))
+
+
+def report(recorded, replayed=None):
+    """Return a table of the latencies of each opcode, in microseconds."""
+    lines = [f'{"opcode":<20} {"ops":>8} {"p50 us":>9} {"p99 us":>9} {"max us":>9}  statuses']
+    for opcode, latencies in sorted(recorded.latencies.items(), key=lambda item: -len(item[1])):
+        rows = [('', latencies, recorded.statuses[opcode])]
+        if replayed is not None:
+            rows = [(' recorded', latencies, recorded.statuses[opcode]),
+                    (' replayed', replayed.latencies.get(opcode, []), replayed.statuses[opcode])]
+        for label, values, statuses in rows:
+            name = command_name(opcode) + label
+            if not values:
+                lines.append(f'{name:<20} {0:>8}')
+                continue
+            values = sorted(values)
+            lines.append(f'{name:<20} {len(values):>8} {percentile(values, 0.5) / 1000:>9.1f} '
+                         f'{percentile(values, 0.99) / 1000:>9.1f} {values[-1] / 1000:>9.1f}  '
+                         f'{format_statuses(statuses)}')
+    return '\n'.join(lines) + '\n'
+
+
+def filler(length, datatype):
+    """Return a value of length bytes standing in for an omitted one."""
+    if datatype & DTYPE_JSON:
+        return b'0' if length == 1 else b'"' + b'x' * (length - 2) + b'"'
+    return bytes(length)
+
+
+def replay_frame(frame, credentials):
+    """Return the frame to send for a recorded request frame."""
+    magic, opcode, datatype, _, body_length, opaque = HEADER_STRUCT.unpack_from(frame)
+    if opcode == memcacheConstants.CMD_SASL_AUTH and magic == REQ_MAGIC_BYTE:
+        keylen = struct.unpack_from('>H', frame, 2)[0]
+        mech = frame[MIN_RECV_PACKET:MIN_RECV_PACKET + keylen]
+        if mech == b'PLAIN':
+            value = '\0'.join(('',) + credentials).encode()
+            return REQ_PKT_STRUCT.pack(magic, opcode, keylen, 0, 0, 0, keylen + len(value),
+                                       opaque, 0) + mech + value
+    missing = MIN_RECV_PACKET + body_length - len(frame)
+    return frame + filler(missing, datatype) if missing > 0 else frame
+
+
+def address_key(address):
+    host, port = address
+    try:
+        ip = ipaddress.ip_address(host)
+        return ip.version, int(ip), '', port
+    except ValueError:
+        return 0, 0, host, port
+
+
+class Replayer(object):
+    """Replays one recorded session over a connection of its own."""
+
+    def __init__(self, session, address, speed, credentials, timeout, started):
+        self.session = session
+        self.address = address
+        self.speed = speed
+        self.credentials = credentials
+        self.timeout = timeout
+        self.started = started
+        self.stats = OpStats()
+        self.received = 0
+        self.stalls = 0
+        self.pending = defaultdict(deque)
+        self.cond = threading.Condition()
+
+    def wait_until(self, ns):
+        if self.speed:
+            delay = self.started + ns / self.speed / 1e9 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def wait_for_responses(self, count):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.received >= count, self.timeout):
+                # The stand-in answered fewer requests than the recorded
+                # server, e.g. succeeded quietly where the original failed
+                self.stalls += 1
+
+    def run(self):
+        self.wait_until(self.session.opened)
+        sock = socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receiver = threading.Thread(target=self.receive, args=(sock,), daemon=True)
+        receiver.start()
+        try:
+            for ns, responses_before, frame in self.session.requests:
+                self.wait_until(ns)
+                self.wait_for_responses(responses_before)
+                frame = replay_frame(frame, self.credentials)
+                _, opcode, _, _, _, opaque = HEADER_STRUCT.unpack_from(frame)
+                with self.cond:
+                    self.pending[opaque].append((opcode, time.perf_counter_ns()))
+                sock.sendall(frame)
+            self.wait_for_responses(len(self.session.responses))
+        finally:
+            # Wakes up the receiver, which holds a file of the socket open
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            receiver.join()
+
+    def receive(self, sock):
+        f = sock.makefile('rb')
+        try:
+            while True:
+                header = f.read(MIN_RECV_PACKET)
+                if len(header) < MIN_RECV_PACKET:
+                    return
+                _, _, _, status, body_length, opaque = HEADER_STRUCT.unpack(header)
+                if len(f.read(body_length)) < body_length:
+                    return
+                now = time.perf_counter_ns()
+                with self.cond:
+                    if self.pending[opaque]:
+                        opcode, sent = self.pending[opaque].popleft()
+                        self.stats.add(opcode, status, now - sent)
+                    self.received += 1
+                    self.cond.notify_all()
+        except OSError:
+            return
+        finally:
+            f.close()
+
+
+def replay(sessions, host, port, speed=1.0, credentials=('Administrator', 'password'),
+           timeout=10.0):
+    """Replay sessions against the nodes of a stand-in server on consecutive
+    ports from port, and return (OpStats, stalls, seconds)."""
+    addresses = sorted({session.address for session in sessions}, key=address_key)
+    node_map = {address: (host, port + i) for i, address in enumerate(addresses)}
+    started = time.perf_counter()
+    replayers = [Replayer(session, node_map[session.address], speed, credentials, timeout, started)
+                 for session in sessions]
+    threads = [threading.Thread(target=r.run) for r in replayers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stats = OpStats()
+    for r in replayers:
+        stats.update(r.stats)
+    return stats, sum(r.stalls for r in replayers), elapsed
+
+
+def capture_span(sessions):
+    """Return the seconds from the first to the last recorded frame."""
+    times = [ns for s in sessions for ns, _, _ in s.requests] + \
+            [ns for s in sessions for ns, _ in s.responses]
+    return (max(times) - min(times)) / 1e9 if times else 0.0
+
+
+def parse_args():
+    parser = ArgumentParser(allow_abbrev=False,
+                            description='Summarize or replay a capture of memcached traffic')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='COMMAND')
+    summary = commands.add_parser('summary', help='Print the op mix and latencies of a capture')
+    summary.add_argument('capture', metavar='FILE')
+    replay = commands.add_parser('replay', help='Replay a capture against a stand-in server')
+    replay.add_argument('capture', metavar='FILE')
+    replay.add_argument('--host', default='127.0.0.1', help='Host of the stand-in server')
+    replay.add_argument('--port', default=11210, type=int,
+                        help='Port of the first node; the others use the following ports')
+    replay.add_argument('-u', '--username', default='Administrator')
+    replay.add_argument('-p', '--password', default='password')
+    replay.add_argument('--speed', default=1.0, type=float,
+                        help='Pacing relative to the recording, e.g. 10 for ten times faster; '
+                             '0 for as fast as the responses allow')
+    replay.add_argument('--timeout', default=10.0, type=float, metavar='SECONDS',
+                        help='Longest wait for a response a request depends on')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    sessions = load_sessions(options.capture)
+    recorded = OpStats()
+    for session in sessions:
+        recorded.update(recorded_stats(session))
+    span = capture_span(sessions)
+    if options.command == 'summary':
+        print(f'{len(sessions)} connections, {sum(len(s.requests) for s in sessions)} requests '
+              f'over {span:.3f} s\n')
+        print(report(recorded), end='')
+        return
+    replayed, stalls, elapsed = replay(sessions, options.host, options.port, options.speed,
+                                       (options.username, options.password), options.timeout)
+    print(f'Replayed {len(sessions)} connections, {sum(len(s.requests) for s in sessions)} requests '
+          f'recorded over {span:.3f} s in {elapsed:.3f} s'
+          + (f', {stalls} stalls' if stalls else '') + '\n')
+    print(report(recorded, replayed), end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,893 @@
+#!/usr/bin/env python3
+"""
+Fake Couchbase KV server speaking the memcached binary protocol.
+
+Runs one or more KV nodes on localhost which share a single in-memory bucket
+and advertise a common vBucketServerMap, so that manage-cid-prefix-keys.py
+can be exercised end to end without a real cluster.  Latency and TMPFAIL
+responses may be injected to model realistic deployments.
+
+Use of this software is governed by the Apache License, Version 2.0, included
+in the file licenses/APL2.txt.
+
+"""
+
+import json
+import random
+import socket
+import socketserver
+import ssl
+import struct
+import threading
+import time
+from argparse import ArgumentParser
+from collections import deque
+from zlib import crc32
+
+import leb128
+import memcacheConstants
+from memcacheConstants import REQ_MAGIC_BYTE, ALT_REQ_MAGIC_BYTE, RES_MAGIC_BYTE
+from memcacheConstants import REQ_PKT_FMT, ALT_REQ_PKT_FMT, RES_PKT_FMT, MIN_RECV_PACKET
+from memcacheConstants import SET_PKT_FMT, GET_RES_FMT, DTYPE_RAW, DTYPE_JSON
+
+SUPPORTED_FEATURES = {memcacheConstants.FEATURE_SELECT_BUCKET,
+                      memcacheConstants.FEATURE_JSON,
+                      memcacheConstants.FEATURE_XATTR,
+                      memcacheConstants.FEATURE_COLLECTIONS,
+                      memcacheConstants.FEATURE_TCPNODELAY}
+
+SUBDOC_FLAG_XATTR_PATH = 0x04
+
+FRAME_DURABILITY = 1
+
+# Opcodes which touch documents and are therefore subject to TMPFAIL injection
+DATA_COMMANDS = {memcacheConstants.CMD_GET, memcacheConstants.CMD_GETQ,
+                 memcacheConstants.CMD_ADD, memcacheConstants.CMD_ADDQ,
+                 memcacheConstants.CMD_DELETE, memcacheConstants.CMD_DELETEQ,
+                 memcacheConstants.CMD_GET_META, memcacheConstants.CMD_SUBDOC_GET,
+                 memcacheConstants.CMD_GET_REPLICA, memcacheConstants.CMD_GET_RANDOM_KEY}
+
+# Opcodes which queue a document for persistence
+MUTATION_COMMANDS = {memcacheConstants.CMD_ADD, memcacheConstants.CMD_ADDQ,
+                     memcacheConstants.CMD_DELETE, memcacheConstants.CMD_DELETEQ}
+
+# Memory accounted for every stored document besides its key and value
+ITEM_OVERHEAD = 56
+
+QUIET_COMMANDS = {memcacheConstants.CMD_GETQ, memcacheConstants.CMD_ADDQ,
+                  memcacheConstants.CMD_DELETEQ}
+
+
+def get_vbid(key, num_vbuckets):
+    """Map a key to its vbucket using the CRC hash algorithm."""
+    return ((crc32(key) >> 16) & 0x7fff) % num_vbuckets
+
+
+class Item(object):
+    """A stored document."""
+
+    __slots__ = ('value', 'flags', 'cas', 'dtype', 'xattrs', 'seqno',
+                 'persisted_at')
+
+    def __init__(self, value, flags, cas, dtype, xattrs=None, seqno=0,
+                 persisted_at=0.0):
+        self.value = value
+        self.flags = flags
+        self.cas = cas
+        self.dtype = dtype
+        self.xattrs = xattrs or {}
+        self.seqno = seqno
+        # time.monotonic() once the disk write queue has drained past it
+        self.persisted_at = persisted_at
+
+
+class FakeBucket(object):
+    """In-memory bucket shared by every node of a FakeCluster.
+
+    Documents are kept per vbucket, keyed by their collection-prefixed key as
+    sent on the wire by clients which negotiated collections. Deleted
+    documents leave a tombstone behind which GET_META still reports."""
+
+    def __init__(self, name, num_vbuckets):
+        self.name = name
+        self.num_vbuckets = num_vbuckets
+        self.vbuckets = [{} for _ in range(num_vbuckets)]
+        self.tombstones = [{} for _ in range(num_vbuckets)]
+        self.high_seqnos = [0] * num_vbuckets
+        self.lock = threading.Lock()
+        self.last_cas = 0
+
+    def next_cas(self):
+        self.last_cas = max(self.last_cas + 1, time.time_ns())
+        return self.last_cas
+
+    def next_seqno(self, vbid):
+        self.high_seqnos[vbid] += 1
+        return self.high_seqnos[vbid]
+
+    def store(self, vbid, key, value, flags=0, dtype=DTYPE_JSON, xattrs=None):
+        """Unconditionally store a document; used to seed test data."""
+        with self.lock:
+            item = Item(value, flags, self.next_cas(), dtype, xattrs,
+                        self.next_seqno(vbid))
+            self.vbuckets[vbid][key] = item
+            self.tombstones[vbid].pop(key, None)
+            return item
+
+    def remove(self, vbid, key):
+        """Replace a document with its tombstone. Must hold the lock."""
+        item = self.vbuckets[vbid].pop(key)
+        tombstone = Item(b'', item.flags, self.next_cas(), DTYPE_RAW,
+                         seqno=self.next_seqno(vbid))
+        self.tombstones[vbid][key] = tombstone
+        return tombstone
+
+
+class FakeCluster(object):
+    """A set of FakeKVNodes listening on localhost which share one bucket."""
+
+    def __init__(self, num_nodes=1, num_vbuckets=1024, num_replicas=0,
+                 bucket='default', username='Administrator',
+                 password='password', host='127.0.0.1', base_port=0,
+                 vbucket_map=None, latency=0.0, jitter=0.0,
+                 tmpfail_rate=0.0, seed=None, ssl_context=None,
+                 durable_latency=0.0, ambiguous_rate=0.0, mem_quota=1 << 30,
+                 drain_rate=0.0):
+        assert num_nodes > 0
+        self.mem_quota = mem_quota
+        self.drain_rate = drain_rate
+        self.durable_latency = durable_latency
+        self.ambiguous_rate = ambiguous_rate
+        self.ssl_context = ssl_context
+        self.bucket = FakeBucket(bucket, num_vbuckets)
+        self.username = username
+        self.password = password
+        self.host = host
+        self.latency = latency
+        self.jitter = jitter
+        self.tmpfail_rate = tmpfail_rate
+        self.random = random.Random(seed)
+        self.nodes = []
+        for i in range(num_nodes):
+            port = base_port + i if base_port else 0
+            self.nodes.append(FakeKVNode(self, i, (host, port)))
+        if vbucket_map is None:
+            vbucket_map = []
+            for vbid in range(num_vbuckets):
+                servers = [(vbid + r) % num_nodes
+                           for r in range(min(num_replicas, num_nodes - 1) + 1)]
+                servers += [-1] * (num_replicas + 1 - len(servers))
+                vbucket_map.append(servers)
+        assert len(vbucket_map) == num_vbuckets
+        self.vbucket_map = vbucket_map
+        self.num_replicas = len(vbucket_map[0]) - 1
+        self.threads = []
+
+    @property
+    def ports(self):
+        return [node.server_address[1] for node in self.nodes]
+
+    def cluster_config(self):
+        return {
+            'rev': 1,
+            'name': self.bucket.name,
+            'nodeLocator': 'vbucket',
+            'bucketCapabilities': ['collections', 'xattr', 'dcp', 'cbhello'],
+            'vBucketServerMap': {
+                'hashAlgorithm': 'CRC',
+                'numReplicas': self.num_replicas,
+                'serverList': ['{}:{}'.format(self.host, port)
+                               for port in self.ports],
+                'vBucketMap': self.vbucket_map,
+            },
+        }
+
+    def is_active(self, node, vbid):
+        return (0 <= vbid < len(self.vbucket_map)
+                and self.vbucket_map[vbid][0] == node.index)
+
+    def is_replica(self, node, vbid):
+        return (0 <= vbid < len(self.vbucket_map)
+                and node.index in self.vbucket_map[vbid][1:])
+
+    def response_delay(self):
+        if not self.latency and not self.jitter:
+            return 0.0
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def inject_tmpfail(self):
+        return self.tmpfail_rate > 0 and self.random.random() < self.tmpfail_rate
+
+    def inject_ambiguous(self):
+        return self.ambiguous_rate > 0 and self.random.random() < self.ambiguous_rate
+
+    def populate(self, count, cid, copies=1, prefix='doc-', value=b'{}',
+                 xattrs=None):
+        """Seed count documents whose keys carry the LEB128 prefix of cid.
+
+        The documents are stored in the default collection, in the vbucket
+        of the prefixed id and, for copies > 1, also in the vbucket of the
+        unprefixed id. Returns the list of prefixed doc ids."""
+        num_vbuckets = self.bucket.num_vbuckets
+        ids = []
+        for i in range(count):
+            stripped_id = (prefix + str(i)).encode()
+            doc_id = leb128.encode_key(stripped_id, cid)
+            key = leb128.encode_key(doc_id)
+            vbids = [get_vbid(doc_id, num_vbuckets),
+                     get_vbid(stripped_id, num_vbuckets)][:copies]
+            for vbid in vbids:
+                self.bucket.store(vbid, key, value, xattrs=xattrs)
+            ids.append(doc_id.decode(errors='ignore'))
+        return ids
+
+    def populate_plain(self, count, prefix='plain-', value=b'{}'):
+        """Seed count documents without a cid key prefix in the default
+        collection."""
+        num_vbuckets = self.bucket.num_vbuckets
+        for i in range(count):
+            doc_id = (prefix + str(i)).encode()
+            self.bucket.store(get_vbid(doc_id, num_vbuckets), leb128.encode_key(doc_id), value)
+
+    def start(self):
+        for node in self.nodes:
+            thread = threading.Thread(target=node.serve_forever, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for node in self.nodes:
+            node.shutdown()
+            node.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class FakeKVNode(socketserver.ThreadingTCPServer):
+    """A single KV node of a FakeCluster."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cluster, index, address):
+        self.cluster = cluster
+        self.index = index
+        self.ops = 0
+        self.disk_queue = 0.0
+        self.disk_queue_time = time.monotonic()
+        self.stats_lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, address, FakeKVConnection)
+
+    def count_op(self, cmd):
+        with self.stats_lock:
+            self.ops += 1
+            if cmd in MUTATION_COMMANDS:
+                self._drain_disk_queue()
+                self.disk_queue += 1
+
+    def disk_queue_size(self):
+        with self.stats_lock:
+            self._drain_disk_queue()
+            return int(self.disk_queue)
+
+    def persist_due(self):
+        """Return when a write queued now will have been persisted."""
+        if not self.cluster.drain_rate:
+            return 0.0
+        with self.stats_lock:
+            self._drain_disk_queue()
+            return self.disk_queue_time + self.disk_queue / self.cluster.drain_rate
+
+    def _drain_disk_queue(self):
+        # Writes are persisted at drain_rate items/s, or at once if it is 0
+        now = time.monotonic()
+        if self.cluster.drain_rate:
+            drained = self.cluster.drain_rate * (now - self.disk_queue_time)
+            self.disk_queue = max(0.0, self.disk_queue - drained)
+        else:
+            self.disk_queue = 0.0
+        self.disk_queue_time = now
+
+    def curr_items(self):
+        """Return the number of documents in the active vbuckets."""
+        bucket = self.cluster.bucket
+        with bucket.lock:
+            return sum(len(docs) for vbid, docs in enumerate(bucket.vbuckets)
+                       if self.cluster.is_active(self, vbid))
+
+    def mem_used(self):
+        """Return the bytes taken by the documents of the active vbuckets."""
+        bucket = self.cluster.bucket
+        used = 0
+        with bucket.lock:
+            for vbid, docs in enumerate(bucket.vbuckets):
+                if self.cluster.is_active(self, vbid):
+                    used += sum(len(key) + len(item.value) + ITEM_OVERHEAD
+                                for key, item in docs.items())
+        return used
+
+    def get_request(self):
+        sock, addr = socketserver.ThreadingTCPServer.get_request(self)
+        if self.cluster.ssl_context is not None:
+            # The handshake is completed by the connection's own thread
+            sock = self.cluster.ssl_context.wrap_socket(
+                sock, server_side=True, do_handshake_on_connect=False)
+        return sock, addr
+
+
+class FakeKVConnection(socketserver.BaseRequestHandler):
+    """Serves the requests of one client connection.
+
+    Responses are handed to a writer thread which releases each of them once
+    the injected latency has elapsed, so pipelined requests overlap their
+    delays as they would over a real network."""
+
+    def setup(self):
+        self.cluster = self.server.cluster
+        self.bucket = None
+        self.user = None
+        self.features = set()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if isinstance(self.request, ssl.SSLSocket):
+            try:
+                self.request.do_handshake()
+            except (ssl.SSLError, OSError):
+                # handle() fails on its first read and drops the connection
+                pass
+        self.pending = deque()
+        self.last_due = 0.0
+        self.pending_cond = threading.Condition()
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_responses, daemon=True)
+        self.writer.start()
+        self.handlers = {
+            memcacheConstants.CMD_HELLO: self.do_hello,
+            memcacheConstants.CMD_SASL_LIST_MECHS: self.do_sasl_list_mechs,
+            memcacheConstants.CMD_SASL_AUTH: self.do_sasl_auth,
+            memcacheConstants.CMD_SELECT_BUCKET: self.do_select_bucket,
+            memcacheConstants.CMD_GET_CLUSTER_CONFIG: self.do_get_cluster_config,
+            memcacheConstants.CMD_NOOP: self.do_noop,
+            memcacheConstants.CMD_STAT: self.do_stat,
+            memcacheConstants.CMD_GET: self.do_get,
+            memcacheConstants.CMD_GETQ: self.do_get,
+            memcacheConstants.CMD_ADD: self.do_add,
+            memcacheConstants.CMD_ADDQ: self.do_add,
+            memcacheConstants.CMD_DELETE: self.do_delete,
+            memcacheConstants.CMD_DELETEQ: self.do_delete,
+            memcacheConstants.CMD_GET_META: self.do_get_meta,
+            memcacheConstants.CMD_GET_REPLICA: self.do_get_replica,
+            memcacheConstants.CMD_SUBDOC_GET: self.do_subdoc_get,
+            memcacheConstants.CMD_OBSERVE: self.do_observe,
+            memcacheConstants.CMD_GET_RANDOM_KEY: self.do_get_random_key,
+        }
+
+    def finish(self):
+        with self.pending_cond:
+            self.closed = True
+            self.pending_cond.notify()
+        self.writer.join()
+
+    def _recv_exactly(self, amount):
+        data = bytearray()
+        while len(data) < amount:
+            chunk = self.request.recv(amount - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return bytes(data)
+
+    def handle(self):
+        while True:
+            try:
+                header = self._recv_exactly(MIN_RECV_PACKET)
+            except (EOFError, OSError):
+                return
+            magic = header[0]
+            if magic == REQ_MAGIC_BYTE:
+                (_, cmd, keylen, extralen, dtype, vbid, bodylen, opaque,
+                 cas) = struct.unpack(REQ_PKT_FMT, header)
+                framing_extras_len = 0
+            elif magic == ALT_REQ_MAGIC_BYTE:
+                (_, cmd, framing_extras_len, keylen, extralen, dtype, vbid,
+                 bodylen, opaque, cas) = struct.unpack(ALT_REQ_PKT_FMT, header)
+            else:
+                return
+            try:
+                body = self._recv_exactly(bodylen)
+            except (EOFError, OSError):
+                return
+            flex = body[:framing_extras_len]
+            extras = body[framing_extras_len:framing_extras_len + extralen]
+            key = body[framing_extras_len + extralen:
+                       framing_extras_len + extralen + keylen]
+            value = body[framing_extras_len + extralen + keylen:]
+            request = Request(cmd, opaque, cas, vbid, dtype, flex, extras, key, value)
+
+            handler = self.handlers.get(cmd)
+            if handler is None:
+                response = self.error(request, memcacheConstants.ERR_UNKNOWN_COMMAND)
+            elif cmd in DATA_COMMANDS and self.cluster.inject_tmpfail():
+                response = self.error(request, memcacheConstants.ERR_ETMPFAIL)
+            else:
+                if cmd in DATA_COMMANDS:
+                    self.server.count_op(cmd)
+                response = handler(request)
+            if response is None:
+                continue
+
+            delay = self.cluster.response_delay()
+            if request.durability:
+                # Sync writes wait for replication before responding
+                delay += self.cluster.durable_latency
+            # Responses must leave in request order, even with jitter
+            due = max(time.monotonic() + delay, self.last_due)
+            self.last_due = due
+            with self.pending_cond:
+                self.pending.append((due, response))
+                self.pending_cond.notify()
+
+    def _write_responses(self):
+        while True:
+            with self.pending_cond:
+                while not self.pending and not self.closed:
+                    self.pending_cond.wait()
+                if not self.pending:
+                    return
+                due, response = self.pending[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.pending_cond.wait(delay)
+                    continue
+                self.pending.popleft()
+            try:
+                self.request.sendall(response)
+            except OSError:
+                return
+
+    def respond(self, request, status=0, extras=b'', key=b'', value=b'',
+                cas=0, dtype=0):
+        return struct.pack(RES_PKT_FMT, RES_MAGIC_BYTE, request.cmd, len(key),
+                           len(extras), dtype, status,
+                           len(extras) + len(key) + len(value),
+                           request.opaque, cas) + extras + key + value
+
+    def error(self, request, status, msg=b''):
+        return self.respond(request, status, value=msg)
+
+    # Connection setup commands
+
+    def do_hello(self, request):
+        requested = struct.unpack('>' + 'H' * (len(request.value) // 2), request.value)
+        self.features = SUPPORTED_FEATURES.intersection(requested)
+        value = struct.pack('>' + 'H' * len(self.features), *sorted(self.features))
+        return self.respond(request, value=value)
+
+    def do_sasl_list_mechs(self, request):
+        return self.respond(request, value=b'PLAIN')
+
+    def do_sasl_auth(self, request):
+        if request.key != b'PLAIN':
+            return self.error(request, memcacheConstants.ERR_AUTH_ERROR)
+        try:
+            _, user, password = request.value.decode().split('\0')
+        except ValueError:
+            return self.error(request, memcacheConstants.ERR_AUTH_ERROR)
+        if user != self.cluster.username or password != self.cluster.password:
+            return self.error(request, memcacheConstants.ERR_AUTH_ERROR)
+        self.user = user
+        return self.respond(request, value=b'Authenticated')
+
+    def do_select_bucket(self, request):
+        if self.user is None:
+            return self.error(request, ErrorCodes.EACCESS)
+        if request.key.decode() != self.cluster.bucket.name:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        self.bucket = self.cluster.bucket
+        return self.respond(request)
+
+    def do_get_cluster_config(self, request):
+        if self.bucket is None:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        config = json.dumps(self.cluster.cluster_config()).encode()
+        return self.respond(request, value=config, dtype=DTYPE_JSON)
+
+    def do_noop(self, request):
+        return self.respond(request)
+
+    def do_stat(self, request):
+        if self.bucket is None:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        node = self.server
+        if request.key == b'vbucket-details':
+            stats = {}
+            with self.bucket.lock:
+                for vbid, docs in enumerate(self.bucket.vbuckets):
+                    if self.cluster.is_active(node, vbid):
+                        stats[f'vb_{vbid}'] = 'active'
+                        stats[f'vb_{vbid}:num_items'] = len(docs)
+            return b''.join([self.respond(request, key=k.encode(), value=str(v).encode())
+                             for k, v in stats.items()] + [self.respond(request)])
+        group, _, arg = request.key.partition(b' ')
+        if group in (b'collections-byid', b'collections-details'):
+            return self.collection_stats(request, group, arg)
+        if request.key:
+            # Only the default, vbucket-details and collections groups are supported
+            return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+        quota = self.cluster.mem_quota
+        stats = {
+            'curr_connections': threading.active_count(),
+            'cmd_total_ops': node.ops,
+            'curr_items': node.curr_items(),
+            'mem_used': node.mem_used(),
+            'ep_max_size': quota,
+            'ep_mem_high_wat': quota * 85 // 100,
+            'ep_mem_low_wat': quota * 75 // 100,
+            'ep_queue_size': node.disk_queue_size(),
+            'ep_flusher_todo': 0,
+        }
+        # One response per stat, terminated by one without a key
+        return b''.join([self.respond(request, key=k.encode(), value=str(v).encode())
+                         for k, v in stats.items()] + [self.respond(request)])
+
+    def collection_stats(self, request, group, arg):
+        """Answer collections-byid [cid] with the items of each collection
+        in the active vbuckets, and collections-details with those of each
+        active vbucket.  Every collection is in the default scope."""
+        node = self.server
+        # vbid => cid => items
+        items = {}
+        with self.bucket.lock:
+            for vbid, docs in enumerate(self.bucket.vbuckets):
+                if self.cluster.is_active(node, vbid):
+                    counts = items[vbid] = {0: 0}
+                    for key in docs:
+                        cid = leb128.decode_key(key)[0]
+                        counts[cid] = counts.get(cid, 0) + 1
+        stats = {}
+        if group == b'collections-details':
+            for vbid, counts in items.items():
+                for cid, count in counts.items():
+                    stats[f'vb_{vbid}:{cid:#x}:items'] = count
+        else:
+            totals = {0: 0}
+            for counts in items.values():
+                for cid, count in counts.items():
+                    totals[cid] = totals.get(cid, 0) + count
+            if arg:
+                cid = int(arg, 16)
+                if cid not in totals:
+                    return self.error(request, ErrorCodes.UNKNOWN_COLLECTION)
+                totals = {cid: totals[cid]}
+            for cid, count in totals.items():
+                stats[f'0x0:{cid:#x}:items'] = count
+        return b''.join([self.respond(request, key=k.encode(), value=str(v).encode())
+                         for k, v in stats.items()] + [self.respond(request)])
+
+    # Document commands
+
+    def _check_vbucket(self, request):
+        """Return an error response if the request cannot be served here."""
+        if self.bucket is None:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        if not self.cluster.is_active(self.server, request.vbid):
+            return self.error(request, memcacheConstants.ERR_NOT_MY_VBUCKET)
+        return None
+
+    def _doc_key(self, request):
+        if memcacheConstants.FEATURE_COLLECTIONS in self.features:
+            return request.key
+        return leb128.encode_key(request.key)
+
+    def do_get(self, request):
+        error = self._check_vbucket(request)
+        if error is not None:
+            return error
+        with self.bucket.lock:
+            item = self.bucket.vbuckets[request.vbid].get(self._doc_key(request))
+        if item is None:
+            if request.cmd in QUIET_COMMANDS:
+                return None
+            return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+        return self.respond(request, extras=struct.pack(GET_RES_FMT, item.flags),
+                            value=item.value, cas=item.cas, dtype=item.dtype)
+
+    def do_get_random_key(self, request):
+        # Like the server, pick a random active vbucket holding documents
+        # of the collection and then a random document of it
+        if self.bucket is None:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        cid = struct.unpack('>I', request.extras)[0] if len(request.extras) == 4 else 0
+        prefix = leb128.prefix(cid)
+        random = self.cluster.random
+        with self.bucket.lock:
+            vbids = [vbid for vbid in range(self.bucket.num_vbuckets)
+                     if self.cluster.is_active(self.server, vbid) and self.bucket.vbuckets[vbid]]
+            random.shuffle(vbids)
+            for vbid in vbids:
+                keys = [key for key in self.bucket.vbuckets[vbid]
+                        if leb128.decode_key(key)[0] == cid]
+                if keys:
+                    key = random.choice(keys)
+                    item = self.bucket.vbuckets[vbid][key]
+                    break
+            else:
+                return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+        if memcacheConstants.FEATURE_COLLECTIONS not in self.features:
+            key = key[len(prefix):]
+        return self.respond(request, extras=struct.pack(GET_RES_FMT, item.flags), key=key,
+                            value=item.value, cas=item.cas, dtype=item.dtype)
+
+    def do_get_replica(self, request):
+        # Replication is instantaneous: replicas share the active's documents
+        if self.bucket is None:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        if not self.cluster.is_replica(self.server, request.vbid):
+            return self.error(request, memcacheConstants.ERR_NOT_MY_VBUCKET)
+        with self.bucket.lock:
+            item = self.bucket.vbuckets[request.vbid].get(self._doc_key(request))
+        if item is None:
+            return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+        return self.respond(request, extras=struct.pack(GET_RES_FMT, item.flags),
+                            key=request.key, value=item.value, cas=item.cas,
+                            dtype=item.dtype)
+
+    def do_add(self, request):
+        error = self._check_vbucket(request)
+        if error is not None:
+            return error
+        flags, _ = struct.unpack(SET_PKT_FMT, request.extras)
+        key = self._doc_key(request)
+        with self.bucket.lock:
+            docs = self.bucket.vbuckets[request.vbid]
+            if key in docs:
+                return self.error(request, memcacheConstants.ERR_KEY_EEXISTS)
+            item = Item(request.value, flags, self.bucket.next_cas(),
+                        request.dtype, seqno=self.bucket.next_seqno(request.vbid),
+                        persisted_at=self.server.persist_due())
+            docs[key] = item
+            self.bucket.tombstones[request.vbid].pop(key, None)
+        if request.durability and self.cluster.inject_ambiguous():
+            # The write is stored, but the client cannot know it
+            return self.error(request, memcacheConstants.ERR_SYNC_WRITE_AMBIGUOUS)
+        if request.cmd in QUIET_COMMANDS:
+            return None
+        return self.respond(request, cas=item.cas)
+
+    def do_delete(self, request):
+        error = self._check_vbucket(request)
+        if error is not None:
+            return error
+        key = self._doc_key(request)
+        with self.bucket.lock:
+            docs = self.bucket.vbuckets[request.vbid]
+            item = docs.get(key)
+            if item is None:
+                return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+            if request.cas and request.cas != item.cas:
+                return self.error(request, memcacheConstants.ERR_KEY_EEXISTS)
+            cas = self.bucket.remove(request.vbid, key).cas
+        if request.cmd in QUIET_COMMANDS:
+            return None
+        return self.respond(request, cas=cas)
+
+    def do_get_meta(self, request):
+        error = self._check_vbucket(request)
+        if error is not None:
+            return error
+        key = self._doc_key(request)
+        with self.bucket.lock:
+            deleted = 0
+            item = self.bucket.vbuckets[request.vbid].get(key)
+            if item is None:
+                deleted = 1
+                item = self.bucket.tombstones[request.vbid].get(key)
+        if item is None:
+            return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+        extras = struct.pack('>IIIQ', deleted, item.flags, 0, item.seqno)
+        return self.respond(request, extras=extras, cas=item.cas)
+
+    def do_observe(self, request):
+        if self.bucket is None:
+            return self.error(request, ErrorCodes.NO_BUCKET)
+        keys = []
+        pos = 0
+        while pos < len(request.value):
+            vbid, keylen = struct.unpack_from('>HH', request.value, pos)
+            pos += 4
+            keys.append((vbid, request.value[pos:pos + keylen]))
+            pos += keylen
+        if not all(self.cluster.is_active(self.server, vbid) for vbid, _ in keys):
+            return self.error(request, memcacheConstants.ERR_NOT_MY_VBUCKET)
+        now = time.monotonic()
+        value = bytearray()
+        with self.bucket.lock:
+            for vbid, key in keys:
+                doc_key = key
+                if memcacheConstants.FEATURE_COLLECTIONS not in self.features:
+                    doc_key = leb128.encode_key(key)
+                item = self.bucket.vbuckets[vbid].get(doc_key)
+                if item is not None:
+                    state = (memcacheConstants.OBSERVE_PERSISTED if item.persisted_at <= now
+                             else memcacheConstants.OBSERVE_NOT_PERSISTED)
+                else:
+                    item = self.bucket.tombstones[vbid].get(doc_key)
+                    state = (memcacheConstants.OBSERVE_LOGICALLY_DELETED if item is not None
+                             else memcacheConstants.OBSERVE_NOT_FOUND)
+                value += struct.pack('>HH', vbid, len(key)) + key
+                value += struct.pack('>BQ', state, item.cas if item is not None else 0)
+        return self.respond(request, value=bytes(value))
+
+    def do_subdoc_get(self, request):
+        error = self._check_vbucket(request)
+        if error is not None:
+            return error
+        pathlen, flags = struct.unpack('>HB', request.extras[:3])
+        path = request.value[:pathlen].decode()
+        with self.bucket.lock:
+            item = self.bucket.vbuckets[request.vbid].get(self._doc_key(request))
+        if item is None:
+            return self.error(request, memcacheConstants.ERR_KEY_ENOENT)
+        if flags & SUBDOC_FLAG_XATTR_PATH:
+            if path == '$XTOC':
+                result = list(item.xattrs)
+            elif path in item.xattrs:
+                result = item.xattrs[path]
+            else:
+                return self.error(request, ErrorCodes.SUBDOC_PATH_ENOENT)
+        else:
+            if not item.dtype & DTYPE_JSON:
+                return self.error(request, ErrorCodes.SUBDOC_DOC_NOTJSON)
+            result = json.loads(item.value)
+            for component in path.split('.'):
+                if not isinstance(result, dict) or component not in result:
+                    return self.error(request, ErrorCodes.SUBDOC_PATH_ENOENT)
+                result = result[component]
+        return self.respond(request, value=json.dumps(result).encode(),
+                            cas=item.cas, dtype=DTYPE_JSON)
+
+
+class Request(object):
+    """A decoded client request."""
+
+    __slots__ = ('cmd', 'opaque', 'cas', 'vbid', 'dtype', 'flex', 'extras',
+                 'key', 'value', 'durability')
+
+    def __init__(self, cmd, opaque, cas, vbid, dtype, flex, extras, key, value):
+        self.cmd = cmd
+        self.opaque = opaque
+        self.cas = cas
+        self.vbid = vbid
+        self.dtype = dtype
+        self.flex = flex
+        self.extras = extras
+        self.key = key
+        self.value = value
+        self.durability = 0
+        # Each framing extra starts with a byte holding its id and length
+        pos = 0
+        while pos < len(flex):
+            frame_id, frame_len = flex[pos] >> 4, flex[pos] & 0xf
+            if frame_id == FRAME_DURABILITY:
+                self.durability = flex[pos + 1]
+            pos += 1 + frame_len
+
+
+class ErrorCodes(object):
+    """Status codes without a memcacheConstants.ERR_* name."""
+
+    NO_BUCKET = 0x08
+    EACCESS = 0x24
+    UNKNOWN_COLLECTION = 0x88
+    SUBDOC_PATH_ENOENT = 0xc0
+    SUBDOC_DOC_NOTJSON = 0xc6
+
+
+def parse_args():
+    parser = ArgumentParser(allow_abbrev=False,
+                            description='Run a fake multi-node Couchbase KV cluster on localhost')
+    parser.add_argument('--nodes', default=1, type=int, help='Number of KV nodes')
+    parser.add_argument('--port', default=11210, type=int,
+                        help='Port of the first node; the others use the following ports (0 for ephemeral)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('-b', '--bucket', default='default')
+    parser.add_argument('-u', '--username', default='Administrator')
+    parser.add_argument('-p', '--password', default='password')
+    parser.add_argument('--vbuckets', default=1024, type=int, choices=[64, 128, 1024])
+    parser.add_argument('--replicas', default=0, type=int)
+    parser.add_argument('--vbucket-map', dest='vbucket_map', metavar='FILE',
+                        help='JSON file with the vBucketMap to advertise')
+    parser.add_argument('--latency', default=0.0, type=float, help='Response latency in milliseconds')
+    parser.add_argument('--jitter', default=0.0, type=float, help='Response latency jitter in milliseconds')
+    parser.add_argument('--tmpfail-rate', dest='tmpfail_rate', default=0.0, type=float,
+                        help='Fraction of document operations failing with TMPFAIL')
+    parser.add_argument('--durable-latency', dest='durable_latency', default=0.0, type=float,
+                        help='Additional latency of durable writes in milliseconds')
+    parser.add_argument('--ambiguous-rate', dest='ambiguous_rate', default=0.0, type=float,
+                        help='Fraction of durable writes answered with SyncWriteAmbiguous')
+    parser.add_argument('--mem-quota', dest='mem_quota', default=1024, type=float,
+                        help='Bucket memory quota per node in MiB, reported by STAT')
+    parser.add_argument('--drain-rate', dest='drain_rate', default=0.0, type=float,
+                        help='Items persisted per second and node; 0 keeps the disk write queue empty')
+    parser.add_argument('--populate', default=0, type=int, metavar='N',
+                        help='Seed N documents with a cid key prefix')
+    parser.add_argument('--cid', default=8, type=int, help='Collection id of the seeded key prefix')
+    parser.add_argument('--plain', default=0, type=int, metavar='N',
+                        help='Seed N documents without a cid key prefix')
+    parser.add_argument('--copies', default=1, type=int, choices=[1, 2],
+                        help='Store seeded documents in the vbucket of the prefixed id, and also of the unprefixed id')
+    parser.add_argument('--value-size', dest='value_size', default=2, type=int,
+                        help='Size in bytes of the seeded JSON values')
+    parser.add_argument('--ids-file', dest='ids_file', metavar='FILE',
+                        help='Write the seeded doc ids to FILE, one JSON string per line')
+    parser.add_argument('--tls-cert', dest='tls_cert', metavar='FILE',
+                        help='Serve TLS with this certificate chain; only with a single node')
+    parser.add_argument('--tls-key', dest='tls_key', metavar='FILE',
+                        help='Private key of --tls-cert')
+    parser.add_argument('--seed', type=int)
+    options = parser.parse_args()
+    if options.tls_cert and options.nodes > 1:
+        # TLS clients connect every node on the TLS port they were given,
+        # as the nodes of a real cluster differ by host rather than port
+        parser.error('--tls-cert serves a single node; --nodes must be 1')
+    return options
+
+
+def main():
+    options = parse_args()
+    vbucket_map = None
+    if options.vbucket_map:
+        with open(options.vbucket_map) as f:
+            vbucket_map = json.load(f)
+    ssl_context = None
+    if options.tls_cert:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(options.tls_cert, options.tls_key)
+    cluster = FakeCluster(num_nodes=options.nodes,
+                          num_vbuckets=len(vbucket_map) if vbucket_map else options.vbuckets,
+                          num_replicas=options.replicas,
+                          bucket=options.bucket,
+                          username=options.username,
+                          password=options.password,
+                          host=options.host,
+                          base_port=options.port,
+                          vbucket_map=vbucket_map,
+                          latency=options.latency / 1000,
+                          jitter=options.jitter / 1000,
+                          tmpfail_rate=options.tmpfail_rate,
+                          seed=options.seed,
+                          ssl_context=ssl_context,
+                          durable_latency=options.durable_latency / 1000,
+                          ambiguous_rate=options.ambiguous_rate,
+                          mem_quota=int(options.mem_quota * (1 << 20)),
+                          drain_rate=options.drain_rate)
+    if options.populate:
+        value = json.dumps({'v': 'x' * max(0, options.value_size - 8)}).encode()
+        ids = cluster.populate(options.populate, options.cid, options.copies, value=value)
+        if options.ids_file:
+            with open(options.ids_file, 'w') as f:
+                for doc_id in ids:
+                    f.write(json.dumps(doc_id) + '\n')
+        print('Populated', len(ids), 'cid-prefixed docs')
+    if options.plain:
+        cluster.populate_plain(options.plain)
+        print('Populated', options.plain, 'docs without a cid key prefix')
+    for node in cluster.nodes:
+        print('Listening on {}:{}'.format(*node.server_address))
+    cluster.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    cluster.stop()
+
+if __name__ == '__main__':
+    main()
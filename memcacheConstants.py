@@ -28,6 +28,7 @@ CMD_APPEND = 0x0e
 CMD_PREPEND = 0x0f
 CMD_STAT = 0x10
 CMD_SETQ = 0x11
+CMD_ADDQ = 0x12
 CMD_DELETEQ = 0x14
 CMD_VERBOSE = 0x1b
 CMD_TOUCH = 0x1c
@@ -158,6 +159,26 @@ VB_SET_PKT_FMT=">I"
 # 8b: purge_before_ts, purge_before_seq, 1b: drop_deletes, spare1, 2b: spare2
 COMPACT_DB_PKT_FMT=">QQBxxxxxxx"
 
+# flags, expiration, seqno, cas (and options) of the *_WITH_META commands
+META_PKT_FMT=">IIQQ"
+META_OPTIONS_PKT_FMT=">IIQQI"
+
+# deleted, flags, expiration, seqno
+GET_META_RES_FMT=">IIIQ"
+
+# vbucket, keylen of each key of an observe request and response
+OBSERVE_KEY_FMT=">HH"
+# keystate, cas following each key of an observe response
+OBSERVE_RES_FMT=">BQ"
+
+# pathlen, flags of the single path subdoc commands
+SUBDOC_PKT_FMT=">HB"
+
+# frame id and length, level (and timeout) of the durability frame of
+# alternative requests
+DURABILITY_FRAME_FMT=">BB"
+DURABILITY_TIMEOUT_FRAME_FMT=">BBH"
+
 MAGIC_BYTE = 0x80
 REQ_MAGIC_BYTE = 0x80
 ALT_REQ_MAGIC_BYTE=0x08
@@ -193,6 +214,32 @@ EXTRA_HDR_FMTS={
 EXTRA_HDR_SIZES=dict(
     [(k, struct.calcsize(v)) for (k,v) in EXTRA_HDR_FMTS.items()])
 
+# Precompiled forms of the formats above, which spare parsing the format
+# string on every request and response
+REQ_PKT_STRUCT = struct.Struct(REQ_PKT_FMT)
+RES_PKT_STRUCT = struct.Struct(RES_PKT_FMT)
+ALT_REQ_PKT_STRUCT = struct.Struct(ALT_REQ_PKT_FMT)
+ALT_RES_PKT_STRUCT = struct.Struct(ALT_RES_PKT_FMT)
+SET_PKT_STRUCT = struct.Struct(SET_PKT_FMT)
+GET_RES_STRUCT = struct.Struct(GET_RES_FMT)
+INCRDECR_PKT_STRUCT = struct.Struct(INCRDECR_PKT_FMT)
+INCRDECR_RES_STRUCT = struct.Struct(INCRDECR_RES_FMT)
+FLUSH_PKT_STRUCT = struct.Struct(FLUSH_PKT_FMT)
+TOUCH_PKT_STRUCT = struct.Struct(TOUCH_PKT_FMT)
+GAT_PKT_STRUCT = struct.Struct(GAT_PKT_FMT)
+GETL_PKT_STRUCT = struct.Struct(GETL_PKT_FMT)
+SET_PARAM_STRUCT = struct.Struct(SET_PARAM_FMT)
+VB_SET_PKT_STRUCT = struct.Struct(VB_SET_PKT_FMT)
+COMPACT_DB_PKT_STRUCT = struct.Struct(COMPACT_DB_PKT_FMT)
+META_PKT_STRUCT = struct.Struct(META_PKT_FMT)
+META_OPTIONS_PKT_STRUCT = struct.Struct(META_OPTIONS_PKT_FMT)
+GET_META_RES_STRUCT = struct.Struct(GET_META_RES_FMT)
+OBSERVE_KEY_STRUCT = struct.Struct(OBSERVE_KEY_FMT)
+OBSERVE_RES_STRUCT = struct.Struct(OBSERVE_RES_FMT)
+SUBDOC_PKT_STRUCT = struct.Struct(SUBDOC_PKT_FMT)
+DURABILITY_FRAME_STRUCT = struct.Struct(DURABILITY_FRAME_FMT)
+DURABILITY_TIMEOUT_FRAME_STRUCT = struct.Struct(DURABILITY_TIMEOUT_FRAME_FMT)
+
 # Kept for backwards compatibility with existing mc_bin_client users.
 
 ERR_UNKNOWN_CMD = 0x81
@@ -219,10 +266,21 @@ ERR_NOT_SUPPORTED = 0x83
 ERR_EINTERNAL = 0x84
 ERR_EBUSY = 0x85
 ERR_ETMPFAIL = 0x86
+ERR_SYNC_WRITE_IN_PROGRESS = 0xa2
+ERR_SYNC_WRITE_AMBIGUOUS = 0xa3
+ERR_SYNC_WRITE_RE_COMMIT_IN_PROGRESS = 0xa4
 
 META_REVID = 0x01
 
 DURABILITY_LEVEL_MAJORITY = 0x1
+DURABILITY_LEVEL_MAJORITY_AND_PERSIST_TO_ACTIVE = 0x2
+DURABILITY_LEVEL_PERSIST_TO_MAJORITY = 0x3
+
+# OBSERVE key states
+OBSERVE_NOT_PERSISTED = 0x00
+OBSERVE_PERSISTED = 0x01
+OBSERVE_NOT_FOUND = 0x80
+OBSERVE_LOGICALLY_DELETED = 0x81
 
 # SetWithMeta options
 FORCE_WITH_META_OP = 0x1